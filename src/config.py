@@ -7,10 +7,139 @@ INDEX = {
     },
     'VECTOR': {
         'DIMENSIONS': 1536,
+        # JSON (array stored as text) or BINARY (native vector type or varbinary in the same binary format)
+        'FORMAT': 'JSON'
+    },
+    'FAISS': {
+        # FLAT, IVF, HNSW, PQ, IVFPQ (HNSW doesn't support removing vectors, so CT updates and deletes make the index
+        # be created again in the background, inserts are applied as usual)
+        'TYPE': 'FLAT',
+        # Custom faiss.index_factory string, overrides TYPE when set (eg: 'IVF4096,PQ64')
+        'FACTORY': None,
+        'NLIST': 1024,
+        'NPROBE': 16,
+        'HNSW_M': 32,
+        'EF_SEARCH': 64,
+        'PQ_M': 64,
+        # How FLAT, IVF and HNSW indexes store vectors: FLOAT32, FP16, SQ8 (1 byte per dimension) or PQ (PQ_M bytes per vector).
+        # HNSW with PQ only supports the L2 metric
+        'STORAGE': 'FLOAT32',
+        # Re-rank REFINE_K_FACTOR * k candidates with exact distances against a full precision copy of the vectors (IndexRefineFlat),
+        # recovers most of the recall lost by SQ8/PQ storage but needs the memory of a FLOAT32 index on top of the codes
+        'REFINE': False,
+        'REFINE_K_FACTOR': 4,
+        'TRAINING_SAMPLE': 100000,
+        # IP (1 - inner product), COSINE (vectors and queries are normalized, results are cosine distances)
+        # or L2 (euclidean distance). Changing it requires the index to be created again, saved indexes built
+        # with another metric are refused on load
+        'METRIC': 'IP',
+        # Batches of changes at least this large are applied to a copy of the index that is then swapped in,
+        # so that queries are not blocked while they are applied (needs memory for a second copy, None to disable)
+        'SHADOW_UPDATE_THRESHOLD': 10000,
+        # Vectors are split by a hash of their id into this many indexes of the same type, built in parallel and searched
+        # in parallel, with each change only touching the shard of its id. Each shard is trained on its own vectors
+        # (NLIST lists per shard for IVF). Filters can't be used with REFINE when there is more than one shard
+        'SHARDS': 1,
+        # Filters that allow at most this many ids (ids or metadata predicates) are searched exactly: IVF indexes scan all
+        # of their lists and HNSW indexes score the allowed vectors directly. Larger filters raise nprobe and efSearch
+        # in proportion to the share of the index they allow (0 to only raise them)
+        'EXACT_FILTER_MAX_IDS': 10000
+    },
+    'LOADER': {
+        'BATCH_SIZE': 10000,
+        # Number of parallel connections used to load vectors, each one reading a partition (id modulo WORKERS) of the table
+        'WORKERS': 1,
+        # Add vectors to the index as they are fetched instead of loading all of them in memory first
+        'STREAM_TO_INDEX': False,
+        # Local folder where the build saves the vectors it loaded, SEGMENT_SIZE rows at a time in id order, so that a build
+        # interrupted by an error or a restart resumes from the last saved segment (None to disable, ignores WORKERS)
+        'CHECKPOINT_PATH': None,
+        'SEGMENT_SIZE': 1000000
+    },
+    'CHANGE_TRACKING': {
+        # JSON (whole diff as a single JSON document) or ROWSET (diff streamed in pages of PAGE_SIZE rows)
+        'FETCH_MODE': 'ROWSET',
+        'PAGE_SIZE': 10000,
+        # Changes applied per polling cycle (plus the rest of the last version read), a larger backlog is drained
+        # over several cycles polled back to back (None for no limit)
+        'MAX_CHANGES_PER_CYCLE': 100000
+    },
+    'PERSISTENCE': {
+        # FAISS (faiss.write_index streamed in chunks) or PICKLE (whole index pickled in a single value)
+        'FORMAT': 'FAISS',
+        'CHUNK_SIZE_MB': 16,
+        # None or ZLIB
+        'COMPRESSION': None,
+        # Changes applied since the last full save are appended to a log that is replayed on load, instead of saving
+        # the whole index every time. The index is saved in full once the log has more than LOG_MAX_ITEMS changes
+        # or every LOG_FULL_SAVE_MINUTES (None or 0 to always save the whole index)
+        'LOG_MAX_ITEMS': 100000,
+        'LOG_FULL_SAVE_MINUTES': 60
+    },
+    'QUERY_CACHE': {
+        # Number of query results kept, least recently used first out (0 to disable)
+        'SIZE': 10000,
+        'TTL_SECONDS': 300
+    },
+    'SNAPSHOT_CACHE': {
+        # Local folder where a copy of the saved index is kept, used on load when it matches the saved version (None to disable)
+        'PATH': None,
+        # Memory map the vector codes of the local snapshot instead of reading them in memory, so that queries are served
+        # right away after a restart, reading pages as they're needed. The index is read in memory once a change is applied to it
+        'MMAP': True
+    },
+    'DATABASE': {
+        # Connections kept open and shared by the jobs of this index, parallel loaders use up to LOADER.WORKERS of them
+        # for the whole load, so the pool always has at least LOADER.WORKERS + 1 connections
+        'POOL_SIZE': 4,
+        # Seconds to wait for a free connection and to log in
+        'ACQUIRE_TIMEOUT_SECONDS': 60,
+        'LOGIN_TIMEOUT_SECONDS': 15,
+        # Seconds a statement can run, for regular queries and for bulk loads and saves of the index (0 for no limit)
+        'QUERY_TIMEOUT_SECONDS': 60,
+        'LOAD_TIMEOUT_SECONDS': 0,
+        # Idle connections older than this are checked with a "select 1" before being used
+        'HEALTH_CHECK_SECONDS': 30,
+        # Transient errors (lost connections, Azure SQL busy or reconfiguring, deadlocks) are retried with exponential backoff
+        'RETRIES': 3,
+        'RETRY_BACKOFF_SECONDS': 1
+    },
+    'METADATA': {
+        # Scalar columns of the source table kept in memory to filter queries on, by name: NUMBER, DATE or STRING
+        # (eg: {'language': 'STRING', 'published_on': 'DATE'}), kept current by change tracking
+        'COLUMNS': {}
     }
 }
 
 BACKGROUND_JOBS = {
     "CHANGE_TRACKING_CRONTAB": "*/1 * * * * *",
-    "SAVE_INDEX_CRONTAB": "0 */1 * * * *"
+    "SAVE_INDEX_CRONTAB": "0 */1 * * * *",
+    # Change tracking is polled on every CHANGE_TRACKING_CRONTAB tick while changes are found, then less and less often
+    # (doubling the interval) while nothing changes, up to this many seconds
+    "CHANGE_TRACKING_MAX_INTERVAL_SECONDS": 30
+}
+
+# Indexes served by this process, by index id. Each one needs its own table/vector column, eg:
+# INDEXES[2] = {**INDEX, 'COLUMN': {'ID': 'id', 'VECTOR': 'title_vector'}}
+INDEXES = {
+    1: INDEX
+}
+
+REGISTRY = {
+    # Least recently used indexes are unloaded when total index memory goes over this budget (None for no limit)
+    'MEMORY_BUDGET_MB': None
+}
+
+QUERY = {
+    # Threads running searches, queries beyond MAX_PENDING (running + queued) are rejected with 429
+    'WORKERS': 4,
+    'MAX_PENDING': 64,
+    # OpenMP threads used by each search (None to leave the FAISS default)
+    'OMP_THREADS': 1,
+    # Concurrent single vector queries arriving within the window are run as one batched search (0 to disable)
+    'BATCH_WINDOW_MS': 1,
+    'MAX_BATCH_SIZE': 64,
+    # Largest k and number of vectors in a batch query accepted, larger requests are rejected with 400
+    'MAX_K': 1000,
+    'MAX_VECTORS': 1000
 }
\ No newline at end of file
@@ -3,19 +3,233 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 from sqlext.database import DatabaseEngine
-from sqlext.index import NoIndex
+from sqlext.index import BaseIndex, NoIndex
+from sqlext.utils import IndexStatus, IndexSubStatus, SearchOptions
 
-from config import INDEX, BACKGROUND_JOBS
+import time
+import asyncio
+import logging
+import threading
+import functools
+import faiss
+from concurrent.futures import ThreadPoolExecutor
 
-class Vector(BaseModel):
+from config import INDEXES, REGISTRY, QUERY, BACKGROUND_JOBS
+
+_logger = logging.getLogger("uvicorn")
+
+class IdFilter(BaseModel):
+    # only these ids
+    ids: list[int] = None
+    # none of these ids
+    exclude_ids: list[int] = None
+    # only ids in any of these [min, max) ranges
+    id_ranges: list[tuple[int, int]] = None
+
+class Predicate(BaseModel):
+    column: str
+    # eq, ne, lt, le, gt, ge, in, not_in, prefix (strings only)
+    op: str = "eq"
+    # a list for in and not_in, dates as ISO strings
+    value: int | float | str | list[int | float | str] = None
+
+class SearchRequest(BaseModel):
+    k: int = 10
+    nprobe: int = None
+    ef_search: int = None
+    # maximum distance of returned results, in the same unit as the returned distances (see FAISS.METRIC)
+    threshold: float = None
+    filter: IdFilter = None
+    # conditions on the metadata columns of the index, all of them must match
+    where: list[Predicate] = None
+
+    def get_search_options(self) -> SearchOptions:
+        f = self.filter or IdFilter()
+        predicates = [(p.column, p.op, p.value) for p in self.where] if self.where else None
+        return SearchOptions(self.nprobe, self.ef_search, self.threshold, f.ids, f.exclude_ids, f.id_ranges, predicates)
+
+class Vector(SearchRequest):
     id: int = None
     vector: list[float] = []
 
+class Vectors(SearchRequest):
+    vectors: list[list[float]] = []
+
+class PollingBackoff:
+    def __init__(self, max_interval:int) -> None:
+        self._max_interval = max_interval or 0
+        self._idle_polls = 0
+        self._next_poll = 0
+        self._last_error:str = None
+
+    def is_due(self) -> bool:
+        return time.monotonic() >= self._next_poll
+
+    def on_poll(self, idle:bool, error:Exception = None):
+        # 1, 2, 4... seconds between polls that find nothing (or fail), back to every tick as soon as something changes
+        self._idle_polls = self._idle_polls + 1 if idle else 0
+        self._last_error = str(error) if error is not None else None
+        delay = 0
+        if (self._idle_polls > 0):
+            delay = min(2 ** (self._idle_polls - 1), self._max_interval)
+        self._next_poll = time.monotonic() + delay
+
+    def get_status(self):
+        return {
+            "idle_polls": self._idle_polls,
+            "last_error": self._last_error,
+            "next_poll_in": max(0, round(self._next_poll - time.monotonic(), 1))
+        }
+
+class IndexEntry:
+    def __init__(self, index_id:int, configuration) -> None:
+        self.id = index_id
+        self.configuration = configuration
+        self.database_engine = DatabaseEngine(configuration)
+        self.index:BaseIndex = NoIndex(index_id)
+        self.last_access = time.monotonic()
+        self.polling = PollingBackoff(BACKGROUND_JOBS.get("CHANGE_TRACKING_MAX_INTERVAL_SECONDS"))
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+class IndexRegistry:
+    def __init__(self, indexes, configuration) -> None:
+        self._entries = {int(index_id): IndexEntry(int(index_id), c) for index_id, c in indexes.items()}
+        self._memory_budget = configuration.get("MEMORY_BUDGET_MB")
+
+    def ids(self) -> list[int]:
+        return list(self._entries.keys())
+
+    def get(self, index_id:int) -> IndexEntry:
+        return self._entries.get(index_id)
+
+    def get_memory_usage(self) -> int:
+        return sum([e.index.get_memory_usage() for e in self._entries.values()])
+
+    def close(self):
+        for e in self._entries.values():
+            e.database_engine.close()
+
+    def get_memory_budget(self) -> int:
+        if (self._memory_budget is None):
+            return None
+        return self._memory_budget * 1024 * 1024
+
+    def enforce_memory_budget(self):
+        budget = self.get_memory_budget()
+        if (budget is None):
+            return
+
+        # least recently used indexes are unloaded first, they are loaded back on their next query
+        memory_usage = self.get_memory_usage()
+        for entry in sorted(self._entries.values(), key=lambda e: e.last_access):
+            if (memory_usage <= budget):
+                break
+            if (entry.index.status != IndexStatus.TRAINED or entry.index.substatus != IndexSubStatus.READY):
+                continue
+            index_memory_usage = entry.index.get_memory_usage()
+            _logger.info(f"Memory usage is over budget, unloading index #{entry.id}...")
+            entry.index.save()
+            entry.index.unload()
+            memory_usage -= index_memory_usage
+
+class QueryQueueFullError(Exception):
+    pass
+
+class QueryExecutor:
+    def __init__(self, configuration) -> None:
+        self._omp_threads = configuration.get("OMP_THREADS")
+        self._max_pending = configuration["MAX_PENDING"]
+        self._pending = 0
+        self._lock = threading.Lock()
+        if (self._omp_threads):
+            faiss.omp_set_num_threads(self._omp_threads)
+        self._executor = ThreadPoolExecutor(
+            max_workers=configuration["WORKERS"], 
+            thread_name_prefix="query", 
+            initializer=self.__initialize_worker)
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if (self._pending >= self._max_pending):
+                raise QueryQueueFullError(f"Too many pending queries ({self._pending}).")
+            self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, functools.partial(fn, *args))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def get_pending(self) -> int:
+        return self._pending
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __initialize_worker(self):
+        # OpenMP thread count is per thread, so it has to be set in each worker
+        if (self._omp_threads):
+            faiss.omp_set_num_threads(self._omp_threads)
+
+class QueryBatcher:
+    def __init__(self, configuration, executor:QueryExecutor) -> None:
+        self._window = configuration.get("BATCH_WINDOW_MS", 0) / 1000
+        self._max_batch_size = configuration["MAX_BATCH_SIZE"]
+        self._executor = executor
+        self._pending:dict[tuple, list] = {}
+        self._timers:dict[tuple, asyncio.TimerHandle] = {}
+
+    async def query(self, entry:IndexEntry, vector:list[float], k:int, options:SearchOptions):
+        if (self._window <= 0):
+            return await self._executor.run(entry.index.query, vector, k, options)
+
+        # a bad vector would fail the whole batch, so it's rejected before joining it
+        dimensions = entry.configuration["VECTOR"]["DIMENSIONS"]
+        if (len(vector) != dimensions):
+            raise ValueError(f"Query vectors must have {dimensions} dimensions.")
+
+        # only queries with the same search options can share a search
+        key = (entry.id, options.get_key())
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((vector, k, future))
+        if (len(pending) >= self._max_batch_size):
+            self.__flush(key, entry, options)
+        elif (len(pending) == 1):
+            self._timers[key] = loop.call_later(self._window, self.__flush, key, entry, options)
+        return await future
+
+    def __flush(self, key, entry:IndexEntry, options:SearchOptions):
+        timer = self._timers.pop(key, None)
+        if (timer is not None):
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if (len(batch) > 0):
+            asyncio.ensure_future(self.__run(entry, options, batch))
+
+    async def __run(self, entry:IndexEntry, options:SearchOptions, batch:list):
+        # search once with the largest k, then give each caller only the results it asked for
+        k = max([b[1] for b in batch])
+        try:
+            result = await self._executor.run(entry.index.query_batch, [b[0] for b in batch], k, options)
+        except Exception as e:
+            for _, _, future in batch:
+                if (not future.done()):
+                    future.set_exception(e)
+            return
+
+        for (_, k, future), r in zip(batch, result["result"]):
+            if (not future.done()):
+                future.set_result({"result": dict(list(r.items())[:k])})
+
 class State:
     def __init__(self) -> None:
         self._scheduler = BackgroundScheduler()
-        self.database_engine = DatabaseEngine(INDEX)
-        self.index = NoIndex()
+        self.registry = IndexRegistry(INDEXES, REGISTRY)
+        self.query_executor = QueryExecutor(QUERY)
+        self.query_batcher = QueryBatcher(QUERY, self.query_executor)
         pass
 
     def get_scheduler(self) -> BackgroundScheduler:
@@ -24,8 +238,11 @@ class State:
     def clear(self):
         self._scheduler.shutdown()
         self._scheduler = None
-        self.database_engine = None
-        self.index = None
+        self.registry.close()
+        self.registry = None
+        self.query_executor.shutdown()
+        self.query_executor = None
+        self.query_batcher = None
 
 class ConfigParser:
     def __init__(self, configuration) -> None:
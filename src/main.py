@@ -7,19 +7,18 @@ from contextlib import asynccontextmanager
 from pydantic import BaseModel
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from sqlext.index import NoIndex
 from sqlext.database import DatabaseEngine
 from sqlext.faiss import FaissIndex, IndexStatus, UpdateResult
 
-from internals import State, Vector, ConfigParser
+from internals import State, SearchRequest, Vector, Vectors, ConfigParser, IndexEntry, QueryQueueFullError
 
-from config import INDEX, BACKGROUND_JOBS
+from config import BACKGROUND_JOBS, QUERY
 
 load_dotenv()
 
 _logger = logging.getLogger("uvicorn")
 
-index_num = os.environ["DEFAULT_INDEX_MODEL_ID"] or 1
+index_num = int(os.environ["DEFAULT_INDEX_MODEL_ID"] or 1)
 api_version = "0.0.3"
 
 state = State()
@@ -34,8 +33,10 @@ async def lifespan(app: FastAPI):
     _logger.info("Save Index Schedule: " + str(_save_index_trigger))
 
     scheduler = state.get_scheduler()
-    scheduler.add_job(change_tracking_monitor, _change_tracking_trigger, id='change_monitor', coalesce=True)
-    scheduler.add_job(save_index, _save_index_trigger, id='save_index', coalesce=True)
+    for index_id in state.registry.ids():
+        scheduler.add_job(change_tracking_monitor, _change_tracking_trigger, args=[index_id], id=f'change_monitor_{index_id}', coalesce=True)
+        scheduler.add_job(save_index, _save_index_trigger, args=[index_id], id=f'save_index_{index_id}', coalesce=True)
+    scheduler.add_job(enforce_memory_budget, _save_index_trigger, id='memory_budget', coalesce=True)
     scheduler.add_job(bootstrap, id="bootstrap")
     scheduler.start()    
     _logger.info("Starting API...")
@@ -45,51 +46,117 @@ async def lifespan(app: FastAPI):
 
 api = FastAPI(lifespan=lifespan)
 
-def assert_index_is_ready():    
-    if (state.index.status != IndexStatus.TRAINED):
+def get_index_entry(index_id:int) -> IndexEntry:
+    entry = state.registry.get(index_id)
+    if (entry is None):
+        raise HTTPException(
+            status_code = HTTPStatus.HTTP_404_NOT_FOUND, 
+            detail = f"Index {index_id} is not configured."
+        )
+    return entry
+
+def assert_index_is_ready(entry:IndexEntry):    
+    entry.touch()
+    if (entry.index.status == IndexStatus.UNLOADED):
+        _logger.info(f"Index #{entry.id} was unloaded, loading it back...")
+        state.get_scheduler().add_job(entry.index.load, id=f"load_index_{entry.id}", replace_existing=True)
+
+    if (entry.index.status != IndexStatus.TRAINED):
+        raise HTTPException(
+            status_code = HTTPStatus.HTTP_400_BAD_REQUEST, 
+            detail = entry.index.get_status()
+        )
+
+def assert_valid_search_request(query:SearchRequest):
+    if (query.k < 1 or (query.nprobe is not None and query.nprobe < 1) or (query.ef_search is not None and query.ef_search < 1)):
+        raise HTTPException(
+            status_code = HTTPStatus.HTTP_400_BAD_REQUEST, 
+            detail = "k, nprobe and ef_search must be positive."
+        )
+    # results are allocated for k per vector, batched queries are searched with the largest k
+    if (query.k > QUERY["MAX_K"]):
         raise HTTPException(
             status_code = HTTPStatus.HTTP_400_BAD_REQUEST, 
-            detail = state.index.get_status()
+            detail = f"k can't be more than {QUERY['MAX_K']}."
         )
 
 def bootstrap():
     _logger.info("Bootstrapping...")
-    state.database_engine.initalize()
+    for index_id in state.registry.ids():
+        entry = state.registry.get(index_id)
+        entry.database_engine.initalize()
+        # a build interrupted by a restart picks up from its last saved segment
+        index = FaissIndex(entry.database_engine, entry.configuration, index_id)
+        if (index.has_checkpoint()):
+            _logger.info(f"Found an interrupted build for index #{index_id}, resuming it...")
+            entry.index = index
+            state.get_scheduler().add_job(index.create, args=["resume"], id=f"resume_index_{index_id}")
     _logger.info("Bootstrap complete.")
 
-def save_index():
-    if (state.index.status != IndexStatus.TRAINED):
+def save_index(index_id:int):
+    entry = state.registry.get(index_id)
+    if (entry.index.status != IndexStatus.TRAINED):
         return
     
     s = state.get_scheduler()
-    s.pause_job("save_index")
+    s.pause_job(f"save_index_{index_id}")
 
-    state.index.save()
+    entry.index.save()
 
-    s.resume_job("save_index")
+    s.resume_job(f"save_index_{index_id}")
 
-def change_tracking_monitor():
-    if (state.index.status != IndexStatus.TRAINED):
+def enforce_memory_budget():
+    state.registry.enforce_memory_budget()
+
+def rebuild_index(index_id:int):
+    entry = state.registry.get(index_id)
+    try:
+        entry.index.create("stale")
+        entry.polling.on_poll(False)
+    except Exception as e:
+        _logger.error(f"Rebuilding index #{index_id} failed: {e}")
+    finally:
+        state.get_scheduler().resume_job(f"change_monitor_{index_id}")
+
+def change_tracking_monitor(index_id:int):
+    entry = state.registry.get(index_id)
+    if (entry.index.status != IndexStatus.TRAINED or not entry.polling.is_due()):
         return
 
+    job_id = f"change_monitor_{index_id}"
     s = state.get_scheduler()
-    s.pause_job("change_monitor")
+    s.pause_job(job_id)
 
-    ur = state.index.update()
+    try:
+        ur = entry.index.update()
+        # a backlog is drained in bounded batches, polled back to back
+        while (ur == UpdateResult.PARTIAL):
+            ur = entry.index.update()
+    except Exception as e:
+        # a failed poll backs off like an idle one, the monitor keeps running and tries again later
+        _logger.error(f"Change tracking for index #{index_id} failed: {e}")
+        entry.polling.on_poll(True, e)
+        s.resume_job(job_id)
+        return
+    # a stale index backs off too, so that a rebuild that keeps failing isn't retried on every tick
+    entry.polling.on_poll(ur in (UpdateResult.NO_CHANGES, UpdateResult.INDEX_IS_STALE))
 
     match ur:
         case UpdateResult.NO_CHANGES:  
-            s.resume_job("change_monitor")
+            s.resume_job(job_id)
         case UpdateResult.DONE:  
-            s.resume_job("change_monitor")
+            s.resume_job(job_id)
+        case UpdateResult.INDEX_BUSY:  
+            s.resume_job(job_id)
+        case UpdateResult.INDEX_NOT_READY:  
+            s.resume_job(job_id)
         case UpdateResult.INDEX_IS_STALE:
-            print(f"No changes found as index is stale. Full rebuild is needed.")
-            print(f"Change detection is stopped.")
-            s.remove_job("change_monitor")       
+            # the monitor stays paused until the new index is swapped in, then it polls from its version
+            _logger.warning(f"Index #{index_id} is stale. Rebuilding it in the background...")
+            s.add_job(rebuild_index, args=[index_id], id=f"rebuild_index_{index_id}", replace_existing=True)
         case UpdateResult.UNKNOWN:
-            print(f"No changes found. Reason unknown.")
-            print(f"Change detection is stopped.")
-            s.remove_job("change_monitor")       
+            _logger.error(f"No changes found for index #{index_id}. Reason unknown. Change detection is stopped.")
+            s.remove_job(job_id)       
 
 @api.get("/")
 def welcome():
@@ -98,19 +165,57 @@ def welcome():
             "version": api_version
             }
 
-@api.post("/index/faiss/create")
-def faiss_create(tasks: BackgroundTasks):    
-    if (isinstance(state.index, NoIndex)):
-        _logger.info("No index found, creating FAISS index...")
-        state.index = FaissIndex(state.database_engine)
+@api.get("/index")
+def index_list():
+    return {
+        "indexes": [state.registry.get(index_id).index.get_status() for index_id in state.registry.ids()],
+        "memory_usage": state.registry.get_memory_usage(),
+        "memory_budget": state.registry.get_memory_budget(),
+        "pending_queries": state.query_executor.get_pending()
+    }
 
-    tasks.add_task(state.index.create)    
+@api.post("/index/{index_id}/faiss/create")
+def faiss_create(index_id: int, tasks: BackgroundTasks):    
+    entry = get_index_entry(index_id)
+    if (not isinstance(entry.index, FaissIndex)):
+        _logger.info(f"No index found, creating FAISS index #{index_id}...")
+        entry.index = FaissIndex(entry.database_engine, entry.configuration, index_id)
+
+    entry.touch()
+    tasks.add_task(entry.index.create)    
     return Response(status_code=202)     
 
-@api.post("/index/faiss/query")
-def faiss_query(query: Vector):
-    assert_index_is_ready()
-    return state.index.query(query.vector, 10)
+async def run_query(query):
+    try:
+        return await query
+    except QueryQueueFullError as e:
+        raise HTTPException(status_code = HTTPStatus.HTTP_429_TOO_MANY_REQUESTS, detail = str(e))
+    except ValueError as e:
+        raise HTTPException(status_code = HTTPStatus.HTTP_400_BAD_REQUEST, detail = str(e))
+
+@api.post("/index/{index_id}/faiss/query")
+async def faiss_query(index_id: int, query: Vector):
+    entry = get_index_entry(index_id)
+    assert_index_is_ready(entry)
+    assert_valid_search_request(query)
+    return await run_query(state.query_batcher.query(entry, query.vector, query.k, query.get_search_options()))
+
+@api.post("/index/{index_id}/faiss/query/batch")
+async def faiss_query_batch(index_id: int, query: Vectors):
+    entry = get_index_entry(index_id)
+    assert_index_is_ready(entry)
+    assert_valid_search_request(query)
+    if (len(query.vectors) == 0):
+        raise HTTPException(
+            status_code = HTTPStatus.HTTP_400_BAD_REQUEST, 
+            detail = "At least one vector is required."
+        )
+    if (len(query.vectors) > QUERY["MAX_VECTORS"]):
+        raise HTTPException(
+            status_code = HTTPStatus.HTTP_400_BAD_REQUEST, 
+            detail = f"At most {QUERY['MAX_VECTORS']} vectors can be searched at once."
+        )
+    return await run_query(state.query_executor.run(entry.index.query_batch, query.vectors, query.k, query.get_search_options()))
 
 # @app.post("/index/faiss/add", status_code=202)
 # def faiss_add(query: Vector):
@@ -119,23 +224,54 @@ def faiss_query(query: Vector):
 #     index.add_with_ids(np.asarray([query.vector]), np.asarray([query.id]))
 #     return get_index_status()
 
-@api.post("/index/faiss/load")
-def faiss_create(tasks: BackgroundTasks):      
-    if (isinstance(state.index, NoIndex)):
-        _logger.info("No index found, loading FAISS index...")
-        state.index = FaissIndex(state.database_engine)
+@api.post("/index/{index_id}/faiss/load")
+def faiss_load(index_id: int, tasks: BackgroundTasks):      
+    entry = get_index_entry(index_id)
+    if (not isinstance(entry.index, FaissIndex)):
+        _logger.info(f"No index found, loading FAISS index #{index_id}...")
+        entry.index = FaissIndex(entry.database_engine, entry.configuration, index_id)
 
-    tasks.add_task(state.index.load)    
+    entry.touch()
+    tasks.add_task(entry.index.load)    
     return Response(status_code=202)
 
-@api.post("/index/faiss/save")
-def faiss_create(tasks: BackgroundTasks):    
-    assert_index_is_ready()
-    tasks.add_task(state.index.save)    
+@api.post("/index/{index_id}/faiss/save")
+def faiss_save(index_id: int, tasks: BackgroundTasks):    
+    entry = get_index_entry(index_id)
+    assert_index_is_ready(entry)
+    tasks.add_task(entry.index.save)    
     return Response(status_code=202)
 
-@api.get("/index/faiss/info")
-def faiss_info():
+@api.get("/index/{index_id}/faiss/info")
+def faiss_info(index_id: int):
+    entry = get_index_entry(index_id)
     return {
-        "state": state.index.get_status()
-    }
\ No newline at end of file
+        "state": entry.index.get_status(),
+        "change_tracking": entry.polling.get_status()
+    }
+
+# Routes without an index id use the default index (DEFAULT_INDEX_MODEL_ID)
+
+@api.post("/index/faiss/create")
+def default_faiss_create(tasks: BackgroundTasks):    
+    return faiss_create(index_num, tasks)
+
+@api.post("/index/faiss/query")
+async def default_faiss_query(query: Vector):
+    return await faiss_query(index_num, query)
+
+@api.post("/index/faiss/query/batch")
+async def default_faiss_query_batch(query: Vectors):
+    return await faiss_query_batch(index_num, query)
+
+@api.post("/index/faiss/load")
+def default_faiss_load(tasks: BackgroundTasks):      
+    return faiss_load(index_num, tasks)
+
+@api.post("/index/faiss/save")
+def default_faiss_save(tasks: BackgroundTasks):    
+    return faiss_save(index_num, tasks)
+
+@api.get("/index/faiss/info")
+def default_faiss_info():
+    return faiss_info(index_num)
@@ -0,0 +1,79 @@
+import os
+import json
+import glob
+import logging
+import numpy as np
+
+_logger = logging.getLogger("uvicorn")
+
+class BuildCheckpoint:
+    def __init__(self, path:str, index_num:int) -> None:
+        self._path = os.path.join(path, f"index-{index_num}")
+        self._manifest_file = os.path.join(self._path, "manifest.json")
+        self.manifest = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self._manifest_file)
+
+    def open(self, signature:dict, get_version) -> dict:
+        # segments are only reused by a build with the same settings, they hold vectors ready to be indexed
+        manifest = self.__read_manifest()
+        if (manifest is not None and manifest["signature"] == signature):
+            _logger.info(f"Resuming build from {len(manifest['segments'])} segments ({manifest['rows']} rows) at version {manifest['data_version']}...")
+            self.manifest = manifest
+            return manifest
+
+        self.clear()
+        os.makedirs(self._path, exist_ok=True)
+        self.manifest = {
+            "signature": signature,
+            "data_version": get_version(),
+            "segments": [],
+            "rows": 0,
+            "last_id": None,
+            "complete": False
+        }
+        self.__write_manifest()
+        return self.manifest
+
+    def add_segment(self, ids:np.ndarray, vectors:np.ndarray, last_id:int):
+        n = len(self.manifest["segments"])
+        file_name = f"segment-{n}.npy"
+        # the manifest is written last, so a segment interrupted while being written is loaded again
+        with open(os.path.join(self._path, file_name + ".tmp"), "wb") as f:
+            np.save(f, ids)
+            np.save(f, vectors)
+        os.replace(os.path.join(self._path, file_name + ".tmp"), os.path.join(self._path, file_name))
+        self.manifest["segments"].append({"file": file_name, "rows": len(ids), "last_id": last_id})
+        self.manifest["rows"] += len(ids)
+        self.manifest["last_id"] = last_id
+        self.__write_manifest()
+
+    def complete(self):
+        self.manifest["complete"] = True
+        self.__write_manifest()
+
+    def read_segments(self):
+        for segment in self.manifest["segments"]:
+            with open(os.path.join(self._path, segment["file"]), "rb") as f:
+                ids = np.load(f)
+                vectors = np.load(f)
+            yield ids, vectors
+
+    def clear(self):
+        for f in glob.glob(os.path.join(self._path, "segment-*")):
+            os.remove(f)
+        if (os.path.exists(self._manifest_file)):
+            os.remove(self._manifest_file)
+        self.manifest = None
+
+    def __read_manifest(self):
+        if (not self.exists()):
+            return None
+        with open(self._manifest_file) as f:
+            return json.load(f)
+
+    def __write_manifest(self):
+        with open(self._manifest_file + ".tmp", "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(self._manifest_file + ".tmp", self._manifest_file)
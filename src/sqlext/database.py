@@ -2,60 +2,385 @@ import os
 import pyodbc
 import logging
 import json
-from .utils import Buffer, VectorSet
+import base64
+import zlib
+import time
+import threading
+import functools
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from .utils import Buffer, VectorSet, VectorFormat, IndexFormat, vectors_from_json, vectors_from_binary
 
 _logger = logging.getLogger("uvicorn")
 
+class ChunkWriter:
+    def __init__(self, cursor, index_id:int, chunk_size:int, compression:str) -> None:
+        self._cursor = cursor
+        self._index_id = index_id
+        self._chunk_size = chunk_size
+        self._compression = compression
+        self._buffer = bytearray()
+        self.chunks = 0
+        self.size = 0
+
+    def write(self, data:bytes):
+        self._buffer += data
+        self.size += len(data)
+        while (len(self._buffer) >= self._chunk_size):
+            self.__flush(self._chunk_size)
+        return len(data)
+
+    def close(self):
+        if (len(self._buffer) > 0):
+            self.__flush(len(self._buffer))
+
+    def __flush(self, size:int):
+        chunk = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        if (self._compression == "ZLIB"):
+            chunk = zlib.compress(chunk)
+        self._cursor.execute("insert into [$vector].[faiss_chunks] ([id], [chunk_id], [data]) values (?, ?, ?)", self._index_id, self.chunks, chunk)
+        self.chunks += 1
+
+class ChunkReader:
+    def __init__(self, cursor, compression:str) -> None:
+        self._cursor = cursor
+        self._compression = compression
+        self._chunk = b""
+        self._offset = 0
+
+    def read(self, size:int) -> bytes:
+        result = bytearray()
+        while (len(result) < size):
+            if (self._offset == len(self._chunk) and not self.__next_chunk()):
+                break
+            n = min(size - len(result), len(self._chunk) - self._offset)
+            result += self._chunk[self._offset:self._offset + n]
+            self._offset += n
+        return bytes(result)
+
+    def __next_chunk(self) -> bool:
+        row = self._cursor.fetchone()
+        if (row == None):
+            return False
+        self._chunk = zlib.decompress(row.data) if self._compression == "ZLIB" else row.data
+        self._offset = 0
+        return True
+
+# connection failures, plus Azure SQL errors raised while a database is busy, throttled or moved
+TRANSIENT_SQLSTATES = ("08S01", "08001", "08003", "08004", "08007", "40001")
+TRANSIENT_ERRORS = ("4060", "4221", "10928", "10929", "40197", "40501", "40613", "49918", "49919", "49920")
+
+def is_transient_error(e:Exception) -> bool:
+    if (not isinstance(e, pyodbc.Error) or len(e.args) < 2):
+        return False
+    return e.args[0] in TRANSIENT_SQLSTATES or any([f"({n})" in str(e.args[1]) for n in TRANSIENT_ERRORS])
+
+def is_connection_error(e:Exception) -> bool:
+    return isinstance(e, (pyodbc.OperationalError, pyodbc.InterfaceError)) or is_transient_error(e)
+
+def transient_retry(method):
+    # for operations that can be run again from scratch, without side effects already visible to the caller
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self._pool.retry(lambda: method(self, *args, **kwargs))
+    return wrapper
+
+class ConnectionPool:
+    def __init__(self, connection_string:str, configuration, min_size:int = 1) -> None:
+        self._connection_string = connection_string
+        self._size = configuration.get("POOL_SIZE", 4)
+        if (not isinstance(self._size, int) or self._size < 1):
+            raise Exception(f"Invalid POOL_SIZE: {self._size}")
+        if (self._size < min_size):
+            _logger.warning(f"POOL_SIZE ({self._size}) is too small for the parallel loaders, using {min_size} connections.")
+            self._size = min_size
+        self._acquire_timeout = configuration.get("ACQUIRE_TIMEOUT_SECONDS", 60)
+        self._login_timeout = configuration.get("LOGIN_TIMEOUT_SECONDS", 15)
+        self._query_timeout = configuration.get("QUERY_TIMEOUT_SECONDS", 60)
+        self._health_check = configuration.get("HEALTH_CHECK_SECONDS", 30)
+        self._retries = configuration.get("RETRIES", 3)
+        self._backoff = configuration.get("RETRY_BACKOFF_SECONDS", 1)
+        self._slots = threading.BoundedSemaphore(self._size)
+        self._lock = threading.Lock()
+        # idle connections, as (connection, last used), most recently used last
+        self._idle = []
+        self._in_use = 0
+        self.created = 0
+        self.discarded = 0
+
+    @contextmanager
+    def connection(self, timeout:int = None):
+        if (not self._slots.acquire(timeout=self._acquire_timeout or None)):
+            raise TimeoutError(f"No database connection available after {self._acquire_timeout} seconds.")
+        conn = None
+        try:
+            conn = self.__acquire()
+            # statement timeout, 0 for none
+            conn.timeout = self._query_timeout if timeout is None else timeout
+            yield conn
+        except Exception as e:
+            if (conn is not None and is_connection_error(e)):
+                self.__discard(conn)
+                conn = None
+            raise
+        finally:
+            if (conn is not None):
+                self.__release(conn)
+            self._slots.release()
+
+    def retry(self, operation):
+        attempt = 0
+        while (True):
+            try:
+                return operation()
+            except pyodbc.Error as e:
+                if (attempt >= self._retries or not is_transient_error(e)):
+                    raise
+                delay = self._backoff * (2 ** attempt)
+                attempt += 1
+                _logger.warning(f"Transient database error, retrying in {delay} seconds ({attempt}/{self._retries}): {e}")
+                time.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn, _ in idle:
+            self.__close(conn)
+
+    def get_status(self):
+        return {
+            "size": self._size,
+            "idle": len(self._idle),
+            "in_use": self._in_use,
+            "created": self.created,
+            "discarded": self.discarded
+        }
+
+    def __acquire(self):
+        while (True):
+            with self._lock:
+                item = self._idle.pop() if len(self._idle) > 0 else None
+            if (item is None):
+                conn = self.retry(self.__connect)
+                break
+            conn, last_used = item
+            # connections idle for a while may have been dropped by the server or a load balancer
+            if (not self._health_check or time.monotonic() - last_used < self._health_check or self.__is_healthy(conn)):
+                break
+            self.__close(conn)
+            self.discarded += 1
+
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def __release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        # anything left uncommitted is rolled back, so that the next user starts from a clean state
+        try:
+            conn.rollback()
+        except pyodbc.Error:
+            self.__close(conn)
+            self.discarded += 1
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+    def __discard(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        self.__close(conn)
+        self.discarded += 1
+
+    def __connect(self):
+        conn = pyodbc.connect(self._connection_string, timeout=self._login_timeout)
+        self.created += 1
+        return conn
+
+    def __is_healthy(self, conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("select 1").fetchval()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def __close(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+
 class DatabaseEngine:
     def __init__(self, configuration) -> None:
         self._connection_string = os.environ["MSSQL"]
         self._configuration = configuration       
+        self._vector_format = VectorFormat(configuration["VECTOR"].get("FORMAT", VectorFormat.JSON))
+        DATABASE = configuration.get("DATABASE", {})
+        # parallel loaders hold a connection each for the whole load, one more is left for change tracking and saves
+        self._pool = ConnectionPool(self._connection_string, DATABASE, configuration["LOADER"].get("WORKERS", 1) + 1)
+        self._load_timeout = DATABASE.get("LOAD_TIMEOUT_SECONDS", 0)
+
+    def close(self):
+        self._pool.close()
 
+    def get_pool_status(self):
+        return self._pool.get_status()
+
+    @transient_retry
     def initalize(self): 
-        conn = pyodbc.connect(self._connection_string) 
-        cursor = conn.cursor()  
-        cursor.execute(f"""
-            if schema_id('$vector') is null begin
-                exec('create schema [$vector] authorization dbo')
-            end
-            if object_id('[$vector].[faiss]') is null begin
-                create table [$vector].[faiss]
-                (
-                    [id] int not null,
-                    [source_table_name] sysname not null,
-                    [id_column_name] sysname not null,
-                    [vector_column_name] sysname not null,
-                    [data] varbinary(max) not null,
-                    [item_count] int not null,
-                    [dimension_count] int null,
-                    [data_version] int not null default(0),
-                    [status] varchar(100) not null,
-                    [updated_on] datetime2 not null,
-                    primary key ([id]),
-                    unique nonclustered ([source_table_name], [vector_column_name])
-                )
-            end                                                              
-        """)
-        cursor.close()
-        conn.commit()
-        conn.close()
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            cursor.execute(f"""
+                if schema_id('$vector') is null begin
+                    exec('create schema [$vector] authorization dbo')
+                end
+                if object_id('[$vector].[faiss]') is null begin
+                    create table [$vector].[faiss]
+                    (
+                        [id] int not null,
+                        [source_table_name] sysname not null,
+                        [id_column_name] sysname not null,
+                        [vector_column_name] sysname not null,
+                        [data] varbinary(max) not null,
+                        [item_count] int not null,
+                        [dimension_count] int null,
+                        [data_version] int not null default(0),
+                        [status] varchar(100) not null,
+                        [updated_on] datetime2 not null,
+                        primary key ([id]),
+                        unique nonclustered ([source_table_name], [vector_column_name])
+                    )
+                end
+                if col_length('[$vector].[faiss]', 'format') is null begin
+                    alter table [$vector].[faiss] add 
+                        [format] varchar(20) null,
+                        [data_size] bigint null,
+                        [compression] varchar(20) null
+                end
+                if object_id('[$vector].[faiss_chunks]') is null begin
+                    create table [$vector].[faiss_chunks]
+                    (
+                        [id] int not null,
+                        [chunk_id] int not null,
+                        [data] varbinary(max) not null,
+                        primary key ([id], [chunk_id])
+                    )
+                end
+                if object_id('[$vector].[faiss_log]') is null begin
+                    create table [$vector].[faiss_log]
+                    (
+                        [id] int not null,
+                        [data_version] int not null,
+                        [item_count] int not null,
+                        [data] varbinary(max) not null,
+                        [created_on] datetime2 not null,
+                        primary key ([id], [data_version])
+                    )
+                end                                                              
+            """)
+            cursor.close()
+            conn.commit()
 
+    @transient_retry
     def save_index(self, index_id:int, index_bin, vectors_count:int, dimension_count:int, data_version:int):
+        with self._pool.connection(self._load_timeout) as conn:
+            cursor = conn.cursor()  
+            cursor.execute("delete from [$vector].[faiss] where id = ?", index_id)
+            cursor.execute("delete from [$vector].[faiss_chunks] where id = ?", index_id)
+            cursor.execute("delete from [$vector].[faiss_log] where id = ?", index_id)
+            conn.commit()
+
+            self.__insert_index(cursor, index_id, index_bin, vectors_count, dimension_count, data_version, IndexFormat.PICKLE, len(index_bin), None)
+            conn.commit()
+
+            cursor.close()
+
+    @transient_retry
+    def save_index_chunks(self, index_id:int, write_data, vectors_count:int, dimension_count:int, data_version:int):
+        PERSISTENCE = self._configuration["PERSISTENCE"]
+        with self._pool.connection(self._load_timeout) as conn:
+            # old and new versions are swapped in a single transaction
+            cursor = conn.cursor()  
+            cursor.execute("delete from [$vector].[faiss] where id = ?", index_id)
+            cursor.execute("delete from [$vector].[faiss_chunks] where id = ?", index_id)
+            cursor.execute("delete from [$vector].[faiss_log] where id = ?", index_id)
+
+            writer = ChunkWriter(cursor, index_id, PERSISTENCE["CHUNK_SIZE_MB"] * 1024 * 1024, PERSISTENCE["COMPRESSION"])
+            write_data(writer.write)
+            writer.close()
+            _logger.info(f"Saved {writer.size} bytes in {writer.chunks} chunks.")
+
+            self.__insert_index(cursor, index_id, b"", vectors_count, dimension_count, data_version, IndexFormat.FAISS, writer.size, PERSISTENCE["COMPRESSION"])
+            conn.commit()
+
+            cursor.close()
+
+    @transient_retry
+    def load_index(self, index_num: int, read_data):
+        with self._pool.connection(self._load_timeout) as conn:
+            cursor = conn.cursor()  
+
+            row = cursor.execute(f"select [data], [data_version], [format], [compression] from [$vector].[faiss] where id = ?", index_num).fetchone()
+            if row == None:
+                return None, 0, None
+            version = row.data_version
+            format = IndexFormat(row.format or IndexFormat.PICKLE)
+            if (format == IndexFormat.PICKLE):
+                data = row.data
+            else:
+                cursor.execute("select [data] from [$vector].[faiss_chunks] where id = ? order by chunk_id", index_num)
+                data = read_data(ChunkReader(cursor, row.compression).read)
+            cursor.close()
+
+        return data, version, format
+
+    def append_index_log(self, index_id:int, entries:list[tuple]):
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            for data_version, item_count, data in entries:
+                cursor.execute("insert into [$vector].[faiss_log] ([id], [data_version], [item_count], [data], [created_on]) values (?, ?, ?, ?, sysdatetime())", 
+                    index_id, data_version, item_count, data)
+            conn.commit()
+            cursor.close()
+
+    def load_index_log(self, index_num:int, from_version:int, on_entry) -> int:
+        with self._pool.connection(self._load_timeout) as conn:
+            cursor = conn.cursor()  
+            cursor.execute("select [data_version], [item_count], [data] from [$vector].[faiss_log] where id = ? and data_version > ? order by data_version", index_num, from_version)
+            items = 0
+            while(True):
+                row = cursor.fetchone()
+                if (row == None):
+                    break
+                on_entry(row.data_version, row.data)
+                items += row.item_count
+            cursor.close()
+        return items
+
+    @transient_retry
+    def get_index_version(self, index_num: int) -> int:
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            version = cursor.execute("select [data_version] from [$vector].[faiss] where id = ?", index_num).fetchval()
+            cursor.close()
+        return version
+
+    def __insert_index(self, cursor, index_id:int, index_bin, vectors_count:int, dimension_count:int, data_version:int, format:str, data_size:int, compression:str):
         CONFIG = self._configuration
         source_table_name = f'[{CONFIG["SCHEMA"]}].[{CONFIG["TABLE"]}]'
         id_column_name = CONFIG["COLUMN"]["ID"]
         vector_column_name = CONFIG["COLUMN"]["VECTOR"]
-        conn = pyodbc.connect(self._connection_string) 
-
-        cursor = conn.cursor()  
-        cursor.execute("delete from [$vector].[faiss] where id = ?", index_id)
-        conn.commit()
-
         cursor.execute("""
             insert into [$vector].[faiss] 
-                ([id], [source_table_name], [id_column_name], [vector_column_name], [data], [item_count], [dimension_count], [data_version], [updated_on], [status])
+                ([id], [source_table_name], [id_column_name], [vector_column_name], [data], [item_count], [dimension_count], [data_version], [updated_on], [status], [format], [data_size], [compression])
             values 
-                (?, ?, ?, ?, ?, ?, ?, ?, sysdatetime(), ?);""", 
+                (?, ?, ?, ?, ?, ?, ?, ?, sysdatetime(), ?, ?, ?, ?);""", 
             index_id, 
             source_table_name, 
             id_column_name, 
@@ -64,60 +389,163 @@ class DatabaseEngine:
             vectors_count, 
             dimension_count, 
             data_version,
-            "CREATED")
-        conn.commit()
+            "CREATED",
+            str(format),
+            data_size,
+            compression)
+    
+    def load_vectors_from_db(self, on_metadata = None, on_progress = None):
+        d = self._configuration["VECTOR"]["DIMENSIONS"]
+        partitions = self.__get_partitions()
+        if (partitions == 1):
+            count = self.get_vectors_count()
+            _logger.info(f"Allocating space for {count} vectors...")
+            result = VectorSet(d, count)
+            current_version = self.stream_vectors_from_db(self.__with_progress(result.add, on_progress), on_metadata)
+        else:
+            # each partition is loaded into its own set, then moved into the final matrix one at a time
+            counts = self.get_partition_counts(partitions)
+            count = sum(counts)
+            _logger.info(f"Allocating space for {count} vectors in {partitions} partitions...")
+            sets = [VectorSet(d, c) for c in counts]
+            current_version = self.__load_partitions(partitions, lambda p: self.__with_progress(sets[p].add, on_progress), on_metadata)
+            result = VectorSet(d, sum([len(vs) for vs in sets]))
+            for p in range(partitions):
+                result.add(sets[p].ids, sets[p].vectors)
+                sets[p] = None
 
-        cursor.close()
-        conn.close()
+        _logger.info("Total rows {0}, total memory footprint {1} MB".format(len(result), int(result.get_memory_usage() / 1024 / 1024)))
+        return current_version, result.ids, result.vectors
 
-    def load_index(self, index_num: int):
-        conn = pyodbc.connect(self._connection_string) 
-        cursor = conn.cursor()  
+    def stream_vectors_from_db(self, on_batch, on_metadata = None):
+        partitions = self.__get_partitions()
+        if (partitions == 1):
+            current_version = self.get_current_version()
+            self.__load_query(self.__get_select_embeddings(), on_batch, on_metadata)
+            return current_version
 
-        row = cursor.execute(f"select [data], [data_version] from [$vector].[faiss] where id = ?", index_num).fetchone()
-        if row == None:
-            return None, 0
-        pkl = row[0]
-        version = row[1]
-        cursor.close()
-        conn.close()
+        lock = threading.Lock()
+        def on_locked_batch(ids, vectors):
+            with lock:
+                on_batch(ids, vectors)
 
-        return pkl, version
-    
-    def load_vectors_from_db(self):    
-        conn = pyodbc.connect(self._connection_string) 
-        cursor = conn.cursor()  
-        current_version = cursor.execute("select change_tracking_current_version() as current_version;").fetchval()
-        cursor.close()
-
-        query = self.__get_select_embeddings()
-        buffer = Buffer()    
-        result = VectorSet(self._configuration["VECTOR"]["DIMENSIONS"])
-        cursor = conn.cursor()
-        cursor.execute(query)
-        tr = 0
-        while(True):
-            buffer.clear()    
-            rows = cursor.fetchmany(10000)
-            if (rows == []):
-                _logger.info("Done")
-                break
+        return self.__load_partitions(partitions, lambda p: on_locked_batch, on_metadata)
 
-            for idx, row in enumerate(rows):
-                buffer.add(row.item_id, json.loads(row.vector))
-            
-            result.add(buffer)
-            tr += (idx+1)
+    def __with_progress(self, on_batch, on_progress):
+        if (on_progress is None):
+            return on_batch
+        def on_batch_with_progress(ids, vectors):
+            on_batch(ids, vectors)
+            on_progress(len(ids))
+        return on_batch_with_progress
 
-            mf = int(result.get_memory_usage() / 1024 / 1024)
-            _logger.info("Loaded {0} rows, total rows {1}, total memory footprint {2} MB".format(idx+1, tr, mf))        
-            
-        cursor.close()
-        conn.commit()
-        conn.close()
-        return current_version, result.ids, result.vectors
+    def stream_segment_from_db(self, after_id:int, size:int, on_batch) -> tuple[int, int]:
+        # segments are read in id order, the last id read is where the next one starts
+        last_id = after_id
+        def on_segment_batch(ids, vectors):
+            nonlocal last_id
+            on_batch(ids, vectors)
+            last_id = int(ids[-1])
+
+        count = self.__load_query(self.__get_select_segment(after_id, size), on_segment_batch)
+        return count, last_id
+
+    def get_row_limit(self) -> int:
+        return self.__get_limit()
+
+    def stream_metadata_from_db(self, on_metadata) -> int:
+        # used when the index itself comes from a saved copy, rows changed after this version are replayed by change tracking
+        current_version = self.get_current_version()
+        self.__load_query(self.__get_select_embeddings(vectors=False), None, on_metadata)
+        return current_version
+
+    def get_metadata_columns(self) -> list[str]:
+        return list(self._configuration.get("METADATA", {}).get("COLUMNS", {}).keys())
+
+    @transient_retry
+    def get_current_version(self) -> int:
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            current_version = cursor.execute("select change_tracking_current_version() as current_version;").fetchval()
+            cursor.close()
+        return current_version
+
+    @transient_retry
+    def get_vectors_count(self) -> int:
+        config = self._configuration
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            count = cursor.execute(f"select count_big(*) from [{config['SCHEMA']}].[{config['TABLE']}]").fetchval()
+            cursor.close()
+
+        limit = self.__get_limit()
+        if (limit):
+            count = min(count, limit)
+        return count
+
+    @transient_retry
+    def get_partition_counts(self, partitions:int) -> list[int]:
+        config = self._configuration
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()  
+            rows = cursor.execute(f"""
+                select {self.__get_partition_expression(partitions)} as partition_id, count_big(*) as item_count 
+                from [{config['SCHEMA']}].[{config['TABLE']}] 
+                group by {self.__get_partition_expression(partitions)}
+            """).fetchall()
+            cursor.close()
+
+        counts = [0] * partitions
+        for row in rows:
+            counts[row.partition_id] = row.item_count
+        return counts
+
+    def __load_partitions(self, partitions:int, get_on_batch, on_metadata = None) -> int:
+        # changes happening while partitions are loaded have a version greater than this one,
+        # so they will be picked up (again) by change tracking once the index is ready
+        current_version = self.get_current_version()
+        _logger.info(f"Loading {partitions} partitions in parallel at version {current_version}...")
+        with ThreadPoolExecutor(max_workers=partitions) as executor:
+            futures = [
+                executor.submit(self.__load_query, self.__get_select_embeddings(p, partitions), get_on_batch(p), on_metadata) 
+                for p in range(partitions)
+            ]
+            for f in futures:
+                f.result()
+        return current_version
+
+    def __load_query(self, query:str, on_batch, on_metadata = None) -> int:
+        batch_size = self._configuration["LOADER"]["BATCH_SIZE"]
+        with self._pool.connection(self._load_timeout) as conn:
+            buffer = Buffer()    
+            cursor = conn.cursor()
+            cursor.execute(query)
+            tr = 0
+            while(True):
+                buffer.clear()    
+                rows = cursor.fetchmany(batch_size)
+                if (rows == []):
+                    _logger.info("Done")
+                    break
+
+                for row in rows:
+                    buffer.add(row.item_id, row.vector if on_batch else None)
+
+                ids = np.asarray(buffer.ids, dtype=np.int64)
+                if (on_batch is not None):
+                    on_batch(ids, self.__parse_vectors(buffer.vectors))
+                if (on_metadata is not None):
+                    on_metadata(ids, self.__get_metadata(rows))
+                tr += len(rows)
+
+                _logger.info("Loaded {0} rows, total rows {1}".format(len(rows), tr))        
+
+            cursor.close()
+            conn.commit()
+        return tr
     
-    def get_changes(self, from_version:int = 0):
+    @transient_retry
+    def get_changes(self, from_version:int = 0, max_changes:int = None):
         EMBEDDINGS = self._configuration
         query = f"""
         declare @fromVersion int = ?
@@ -151,15 +579,17 @@ class DatabaseEngine:
                 'Diff' as 'Metadata.Sync.Type',
                 @reason as 'Metadata.Sync.ReasonCode',       
                 [Data] = json_query((
-                    select 
+                    select {self.__get_top_changes(max_changes)}
                         ct.SYS_CHANGE_OPERATION as '$operation',
                         ct.SYS_CHANGE_VERSION as '$version',
                         ct.[{EMBEDDINGS['COLUMN']['ID']}] as id, 
-                        t.[{EMBEDDINGS['COLUMN']['VECTOR']}] as vector
+                        {self.__get_vector_column('t')} as vector{self.__get_metadata_columns('t', "'$metadata.{0}'")}
                     from 
                         [{EMBEDDINGS["SCHEMA"]}].[{EMBEDDINGS["TABLE"]}] as t 
                     right outer join 
                         changetable(changes [{EMBEDDINGS["SCHEMA"]}].[{EMBEDDINGS["TABLE"]}] , @fromVersion) as ct on ct.[{EMBEDDINGS['COLUMN']['ID']}] = t.[{EMBEDDINGS['COLUMN']['ID']}]
+                    order by
+                        ct.SYS_CHANGE_VERSION
                     for 
                         json path
                 ))
@@ -170,22 +600,129 @@ class DatabaseEngine:
         end
         """
             
-        conn = pyodbc.connect(self._connection_string)     
-        cursor = conn.cursor()
-        #print(from_version)
-        cursor.execute(query, from_version)
-        result = cursor.fetchone()
-        result = json.loads(result[0])
-        cursor.close()
-        conn.close()
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            #print(from_version)
+            cursor.execute(query, from_version)
+            result = cursor.fetchone()
+            result = json.loads(result[0])
+            cursor.close()
         return result
 
-    def __get_select_embeddings(self):
-        limit:int = int(os.environ["LIMIT_ROWS"] or -1) 
-        config = self._configuration
+    def get_max_changes(self) -> int:
+        return self._configuration["CHANGE_TRACKING"].get("MAX_CHANGES_PER_CYCLE")
 
-        if (limit == -1):
-            limit = None
+    def stream_changes(self, from_version:int, on_page):
+        max_changes = self.get_max_changes()
+        if (self._configuration["CHANGE_TRACKING"]["FETCH_MODE"] != "ROWSET"):
+            result = self.get_changes(from_version, max_changes)
+            sync = result["Metadata"]["Sync"]
+            if (sync["Type"] == "Diff"):
+                data = result.get("Data") or []
+                on_page(data)
+                if (max_changes and len(data) >= max_changes):
+                    self.__set_partial(sync, max([int(c["$version"]) for c in data]))
+            return sync
+
+        EMBEDDINGS = self._configuration
+        table_name = f'[{EMBEDDINGS["SCHEMA"]}].[{EMBEDDINGS["TABLE"]}]'
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            row = cursor.execute(f"""
+                select 
+                    change_tracking_current_version() as current_version,
+                    change_tracking_min_valid_version(object_id('{table_name}')) as min_valid_version
+            """).fetchone()
+
+            sync = {
+                "Version": row.current_version,
+                "Type": "None",
+                "ReasonCode": 0
+            }
+            # Full rebuild needed
+            if (from_version < row.min_valid_version):
+                sync["ReasonCode"] = 2
+            # No Changes
+            if (from_version == row.current_version):
+                sync["ReasonCode"] = 1
+
+            if (sync["ReasonCode"] == 0):
+                sync["Type"] = "Diff"
+                page_size = self._configuration["CHANGE_TRACKING"]["PAGE_SIZE"]
+                cursor.execute(f"""
+                    select {self.__get_top_changes(max_changes)}
+                        ct.SYS_CHANGE_OPERATION as operation,
+                        ct.SYS_CHANGE_VERSION as version,
+                        ct.[{EMBEDDINGS['COLUMN']['ID']}] as id, 
+                        {self.__get_vector_column('t')} as vector{self.__get_metadata_columns('t')}
+                    from 
+                        {table_name} as t 
+                    right outer join 
+                        changetable(changes {table_name}, ?) as ct on ct.[{EMBEDDINGS['COLUMN']['ID']}] = t.[{EMBEDDINGS['COLUMN']['ID']}]
+                    order by
+                        ct.SYS_CHANGE_VERSION
+                """, from_version)
+                count = 0
+                while(True):
+                    rows = cursor.fetchmany(page_size)
+                    if (rows == []):
+                        break
+                    on_page([{"$operation": r.operation, "$version": r.version, "id": r.id, "vector": r.vector, "$metadata": self.__get_row_metadata(r)} for r in rows])
+                    count += len(rows)
+                    last_version = rows[-1].version
+
+                if (max_changes and count >= max_changes):
+                    self.__set_partial(sync, last_version)
+
+            cursor.close()
+        return sync
+
+    def __get_top_changes(self, max_changes:int) -> str:
+        # rows of the last version read are all included, so that every version up to it is complete
+        if (not max_changes):
+            return ""
+        return f"top({int(max_changes)}) with ties"
+
+    def __set_partial(self, sync:dict, last_version:int):
+        # changetable only returns the latest change of each row, so changes after last_version are picked up by the next call
+        sync["Version"] = last_version
+        sync["Partial"] = True
+
+    def parse_changed_vectors(self, values:list) -> np.ndarray:
+        # varbinary values in a "for json" result are base64 encoded
+        if (self._vector_format == VectorFormat.BINARY):
+            values = [base64.b64decode(v) if isinstance(v, str) else v for v in values]
+        return self.__parse_vectors(values)
+
+    def __parse_vectors(self, values) -> np.ndarray:
+        if (self._vector_format == VectorFormat.BINARY):
+            return vectors_from_binary(values, self._configuration["VECTOR"]["DIMENSIONS"])
+        return vectors_from_json(values)
+
+    def __get_metadata(self, rows) -> dict[str, list]:
+        # metadata columns are always the last ones of the select list
+        columns = self.get_metadata_columns()
+        return {c: [row[i - len(columns)] for row in rows] for i, c in enumerate(columns)}
+
+    def __get_row_metadata(self, row) -> dict:
+        columns = self.get_metadata_columns()
+        return {c: row[i - len(columns)] for i, c in enumerate(columns)}
+
+    def __get_metadata_columns(self, table_alias:str = None, alias:str = None) -> str:
+        prefix = f"{table_alias}." if table_alias else ""
+        return "".join([f", {prefix}[{c}]" + (f" as {alias.format(c)}" if alias else "") for c in self.get_metadata_columns()])
+
+    def __get_vector_column(self, table_alias:str = None):
+        column = f"[{self._configuration['COLUMN']['VECTOR']}]"
+        if (table_alias):
+            column = f"{table_alias}.{column}"
+        if (self._vector_format == VectorFormat.BINARY):
+            return f"cast({column} as varbinary(8000))"
+        return column
+
+    def __get_select_embeddings(self, partition:int = None, partitions:int = 1, vectors:bool = True):
+        limit = self.__get_limit()
+        config = self._configuration
         
         limit_query = ""
         if (limit):
@@ -194,10 +731,38 @@ class DatabaseEngine:
 
         embeddings_table_name = f"[{config['SCHEMA']}].[{config['TABLE']}]"
         query = f"""
-            select {limit_query} {config['COLUMN']['ID']} as item_id, {config['COLUMN']['VECTOR']} as vector from {embeddings_table_name} 
+            select {limit_query} {config['COLUMN']['ID']} as item_id{', ' + self.__get_vector_column() + ' as vector' if vectors else ''}{self.__get_metadata_columns()} from {embeddings_table_name} 
         """
 
+        if (partition is not None):
+            query += f" where {self.__get_partition_expression(partitions)} = {partition}"
+
         if (limit):
             query += " order by item_id"
 
-        return query
\ No newline at end of file
+        return query
+
+    def __get_select_segment(self, after_id:int, size:int):
+        config = self._configuration
+        id_column = f"[{config['COLUMN']['ID']}]"
+        where = f"where {id_column} > {int(after_id)}" if after_id is not None else ""
+        return f"""
+            select top({int(size)}) {id_column} as item_id, {self.__get_vector_column()} as vector from [{config['SCHEMA']}].[{config['TABLE']}] 
+            {where} order by {id_column}
+        """
+
+    def __get_partition_expression(self, partitions:int):
+        return f"abs([{self._configuration['COLUMN']['ID']}] % {partitions})"
+
+    def __get_partitions(self) -> int:
+        partitions = self._configuration["LOADER"].get("WORKERS", 1)
+        if (partitions > 1 and self.__get_limit()):
+            _logger.info("LIMIT_ROWS is set, loading vectors with a single connection.")
+            return 1
+        return partitions
+
+    def __get_limit(self):
+        limit:int = int(os.environ["LIMIT_ROWS"] or -1) 
+        if (limit == -1):
+            return None
+        return limit
\ No newline at end of file
@@ -1,167 +1,979 @@
 import json
 import os
+import math
 import pickle
 import logging
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .index import BaseIndex
 from .database import DatabaseEngine
-from .utils import NpEncoder, IndexStatus, IndexSubStatus, UpdateResult
+from .snapshot import SnapshotCache
+from .metadata import MetadataStore
+from .journal import ChangeJournal
+from .checkpoint import BuildCheckpoint
+from .shards import new_index_shards, is_sharded, get_shards, split_by_shard, clone_index_shards, copy_index_shards, write_index_shards, read_index_shards
+from .utils import NpEncoder, IndexStatus, IndexSubStatus, UpdateResult, VectorSet, ReadWriteLock, IndexFormat, ResultCache, SearchOptions, BuildProgress
 import faiss
+from faiss.contrib.factory_tools import reverse_index_factory
 
 _logger = logging.getLogger("uvicorn")
 
+class IndexIsStaleError(Exception):
+    pass
+
+def get_id_selector(ids:np.ndarray = None, exclude_ids:list[int] = None, id_ranges:list[tuple[int, int]] = None):
+    selectors = []
+    references = []
+
+    if (ids is not None):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        max_id = int(ids[-1]) if len(ids) > 0 else 0
+        if (len(ids) > 0 and ids[0] >= 0 and max_id // 8 <= len(ids) * 8):
+            # dense id lists are cheaper to check as a bitmap than as a hash set
+            bits = np.zeros(max_id + 1, dtype=bool)
+            bits[ids] = True
+            bitmap = np.packbits(bits, bitorder="little")
+            references.append(bitmap)
+            selectors.append(faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+        else:
+            selectors.append(faiss.IDSelectorBatch(ids))
+
+    if (id_ranges):
+        ranges = [faiss.IDSelectorRange(int(r[0]), int(r[1])) for r in id_ranges]
+        references.extend(ranges)
+        selector = ranges[0]
+        for r in ranges[1:]:
+            selector = faiss.IDSelectorOr(selector, r)
+            references.append(selector)
+        selectors.append(selector)
+
+    if (exclude_ids):
+        excluded = faiss.IDSelectorBatch(np.asarray(exclude_ids, dtype=np.int64))
+        references.append(excluded)
+        selectors.append(faiss.IDSelectorNot(excluded))
+
+    if (len(selectors) == 0):
+        return None, references
+
+    references.extend(selectors)
+    selector = selectors[0]
+    for s in selectors[1:]:
+        selector = faiss.IDSelectorAnd(selector, s)
+        references.append(selector)
+    return selector, references
+
+def add_with_ids(index:faiss.Index, ids:np.ndarray, vectors:np.ndarray):
+    if (not is_sharded(index)):
+        index.add_with_ids(vectors, ids)
+        return
+
+    shards = get_shards(index)
+    for n, positions in split_by_shard(ids, len(shards)):
+        if (len(positions) > 0):
+            shards[n].add_with_ids(vectors[positions], ids[positions])
+    faiss.downcast_index(index).syncWithSubIndexes()
+
+def remove_ids(index:faiss.Index, ids:np.ndarray) -> int:
+    if (is_sharded(index)):
+        shards = get_shards(index)
+        removed = 0
+        for n, positions in split_by_shard(ids, len(shards)):
+            if (len(positions) > 0):
+                removed += remove_ids(shards[n], ids[positions])
+        faiss.downcast_index(index).syncWithSubIndexes()
+        return removed
+
+    index = faiss.downcast_index(index)
+    refine = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else None
+    if (not isinstance(refine, faiss.IndexRefine)):
+        return index.remove_ids(faiss.IDSelectorBatch(ids))
+
+    # IndexRefine doesn't implement remove_ids, so vectors are removed from both of its indexes,
+    # keeping the internal ids (positions in the refine index) of the remaining ones aligned
+    id_map = faiss.vector_to_array(index.id_map)
+    positions = np.flatnonzero(np.isin(id_map, ids))
+    if (len(positions) == 0):
+        return 0
+
+    selector = faiss.IDSelectorBatch(positions)
+    base_index = faiss.downcast_index(refine.base_index)
+    base_index.remove_ids(selector)
+    ivf = faiss.try_extract_index_ivf(base_index)
+    if (ivf is not None):
+        # IVF lists keep the ids they were added with, while the refine index is compacted
+        for l in range(ivf.nlist):
+            n = ivf.invlists.list_size(l)
+            if (n > 0):
+                list_ids = faiss.rev_swig_ptr(ivf.invlists.get_ids(l), n)
+                list_ids -= np.searchsorted(positions, list_ids)
+    faiss.downcast_index(refine.refine_index).remove_ids(selector)
+    refine.ntotal = refine.refine_index.ntotal
+
+    faiss.copy_array_to_vector(np.delete(id_map, positions), index.id_map)
+    index.ntotal = refine.ntotal
+    return len(positions)
+
+class IndexBuilder:
+    def __init__(self, index:faiss.Index, training_sample:int) -> None:
+        self.index = index
+        self._training_sample = training_sample
+        self._pending = VectorSet(index.d)
+
+    def add(self, ids:np.ndarray, vectors:np.ndarray):
+        if (self.index.is_trained):
+            self.index.add_with_ids(vectors, ids)
+            return
+
+        # vectors are kept aside until there are enough of them to train the index
+        if (len(self._pending) == 0 and len(ids) >= self._training_sample):
+            self._train(vectors)
+            self.index.add_with_ids(vectors, ids)
+            return
+
+        self._pending.add(ids, vectors)
+        if (len(self._pending) >= self._training_sample):
+            self._flush()
+
+    def finish(self) -> faiss.Index:
+        if (len(self._pending) > 0):
+            self._flush()
+        return self.index
+
+    def _flush(self):
+        self._train(self._pending.vectors)
+        self.index.add_with_ids(self._pending.vectors, self._pending.ids)
+        self._pending = VectorSet(self.index.d)
+
+    def _train(self, vectors:np.ndarray):
+        n = vectors.shape[0]
+        sample_size = min(n, self._training_sample)
+        _logger.info(f"Training index on {sample_size} of {n} vectors...")
+        if (sample_size < n):
+            sample = np.sort(np.random.default_rng().choice(n, sample_size, replace=False))
+            self.index.train(vectors[sample])
+        else:
+            self.index.train(vectors)
+        _logger.info("Done training index.")
+
+class ShardedIndexBuilder:
+    def __init__(self, shards:list[faiss.Index], training_sample:int) -> None:
+        self._builders = [IndexBuilder(s, training_sample) for s in shards]
+        self._executor = ThreadPoolExecutor(len(shards), thread_name_prefix="shard-builder")
+        self._futures = []
+
+    def add(self, ids:np.ndarray, vectors:np.ndarray):
+        # each shard is trained and filled by its own thread, while the next batch is loaded;
+        # a shard only gets its next batch once it's done with the previous one
+        self._wait()
+        ids = np.asarray(ids, dtype=np.int64)
+        for n, positions in split_by_shard(ids, len(self._builders)):
+            if (len(positions) > 0):
+                self._futures.append(self._executor.submit(self._builders[n].add, ids[positions], vectors[positions]))
+
+    def finish(self) -> faiss.Index:
+        try:
+            self._wait()
+            self._futures = [self._executor.submit(b.finish) for b in self._builders]
+            shards = [f.result() for f in self._futures]
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+        return new_index_shards(shards)
+
+    def _wait(self):
+        futures = self._futures
+        self._futures = []
+        for f in futures:
+            f.result()
+
 class FaissIndex(BaseIndex):
-    def __init__(self, db:DatabaseEngine) -> None:
-        super().__init__()
+    def __init__(self, db:DatabaseEngine, configuration, index_num:int = 1) -> None:
+        super().__init__(index_num)
         self._data_version:int = 0
         self._saved_data_version:int = 0
         self._db = db
-        self.index:faiss.IndexFlat = None
-
-    def create(self):
-        self.status = IndexStatus.CREATING
-        self.index = None
-        
-        _logger.info(f"Starting create index #{self._index_num}...")
-
-        _logger.info("Loading data...")
-        version, ids, vectors = self._db.load_vectors_from_db()
-        
-        _logger.info("Creating index...")
-        nvp = np.asarray(vectors)
-        d = nvp.shape[1]
-        index = faiss.IndexFlatIP(d)
-        
-        #nlist = 100
-        #ivf = faiss.IndexIVFFlat(index, d, nlist)
-        #ivf.train(nvp)
-        #ivf.nprobe = 4
-        
-        index_map = faiss.IndexIDMap(index)
-        index_map.add_with_ids(nvp, ids)
-        _logger.info(f"Done creating index ({type(index_map)}).")
-
-        self.index = index_map
-        self._data_version = version
-        self.status = IndexStatus.TRAINED
-        self.substatus = IndexSubStatus.READY
+        self._configuration = configuration
+        self._factory:str = None
+        self._lock = ReadWriteLock()
+        self._write_lock = threading.Lock()
+        self._shadow_index:faiss.Index = None
+        # set while the index codes are memory mapped from the snapshot, they're read in memory before the first change
+        self._mapped = False
+        self._snapshot_cache:SnapshotCache = None
+        if (configuration["SNAPSHOT_CACHE"]["PATH"]):
+            self._snapshot_cache = SnapshotCache(configuration["SNAPSHOT_CACHE"]["PATH"], self._index_num)
+        self._cache = ResultCache(configuration["QUERY_CACHE"]["SIZE"], configuration["QUERY_CACHE"]["TTL_SECONDS"])
+        self._metadata = self.__new_metadata()
+        PERSISTENCE = configuration["PERSISTENCE"]
+        self._build = BuildProgress()
+        self._checkpoint:BuildCheckpoint = None
+        if (configuration["LOADER"].get("CHECKPOINT_PATH")):
+            self._checkpoint = BuildCheckpoint(configuration["LOADER"]["CHECKPOINT_PATH"], self._index_num)
+        self._journal = ChangeJournal(PERSISTENCE.get("LOG_MAX_ITEMS"), PERSISTENCE.get("LOG_FULL_SAVE_MINUTES"), PERSISTENCE["COMPRESSION"])
+        self.index:faiss.Index = None
+
+    def create(self, reason:str = "requested"):
+        with self._write_lock:
+            self.__begin(IndexStatus.CREATING, IndexSubStatus.BUILDING)
+            self._build.start(reason)
+            try:
+                _logger.info(f"Starting create index #{self._index_num} ({reason})...")
+                self._build.total_rows = self._db.get_vectors_count()
+
+                d = self._configuration["VECTOR"]["DIMENSIONS"]
+                builder = self._new_builder(d)
+                metadata = self.__new_metadata()
+                on_metadata = metadata.add if metadata.enabled else None
+
+                if (self._checkpoint is not None):
+                    version = self.__load_segments(builder)
+                    if (metadata.enabled):
+                        self._db.stream_metadata_from_db(metadata.add)
+                elif (self._configuration["LOADER"]["STREAM_TO_INDEX"]):
+                    _logger.info("Loading data and streaming it into the index...")
+                    def on_batch(ids, vectors):
+                        builder.add(ids, self._normalize(vectors))
+                        self._build.add_rows(len(ids))
+                    version = self._db.stream_vectors_from_db(on_batch, on_metadata)
+                    self._build.phase = "indexing"
+                else:
+                    _logger.info("Loading data...")
+                    version, ids, vectors = self._db.load_vectors_from_db(on_metadata, self._build.add_rows)
+                    _logger.info("Creating index...")
+                    self._build.phase = "indexing"
+                    builder.add(ids, self._normalize(vectors))
+                    del ids, vectors
+
+                index = builder.finish()
+                metadata.finish()
+                self._set_search_parameters(index)
+                _logger.info(f"Done creating index ({type(index)}).")
+            except Exception as e:
+                self._build.finish(e)
+                self.__rollback()
+                raise
+
+            self._build.finish()
+            self.__swap(index, version, self._saved_data_version, metadata)
+            self._journal.reset()
+            if (self._checkpoint is not None):
+                self._checkpoint.clear()
+
+    def has_checkpoint(self) -> bool:
+        return self._checkpoint is not None and self._checkpoint.exists()
+
+    def __load_segments(self, builder:IndexBuilder) -> int:
+        LOADER = self._configuration["LOADER"]
+        d = self._configuration["VECTOR"]["DIMENSIONS"]
+        signature = {"factory": self._factory, "dimensions": d, "metric": self._get_metric(), "segment_size": LOADER["SEGMENT_SIZE"]}
+        manifest = self._checkpoint.open(signature, self._db.get_current_version)
+        self._build.add_rows(manifest["rows"])
+
+        limit = self._db.get_row_limit()
+        while (not manifest["complete"]):
+            size = LOADER["SEGMENT_SIZE"] if not limit else min(LOADER["SEGMENT_SIZE"], limit - manifest["rows"])
+            segment = VectorSet(d, size)
+            def on_batch(ids, vectors):
+                segment.add(ids, self._normalize(vectors))
+                self._build.add_rows(len(ids))
+            count, last_id = self._db.stream_segment_from_db(manifest["last_id"], size, on_batch)
+            if (count > 0):
+                self._checkpoint.add_segment(segment.ids, segment.vectors, last_id)
+                _logger.info(f"Saved segment {len(manifest['segments'])} ({manifest['rows']} rows, up to id {last_id}).")
+            if (count < size or (limit and manifest["rows"] >= limit)):
+                self._checkpoint.complete()
+
+        _logger.info(f"Indexing {manifest['rows']} rows from {len(manifest['segments'])} segments...")
+        self._build.phase = "indexing"
+        for ids, vectors in self._checkpoint.read_segments():
+            builder.add(ids, vectors)
+        return manifest["data_version"]
 
     def load(self):
-        self.status = IndexStatus.LOADING
-        self.substatus: IndexSubStatus.NONE
-        self.index = None
-        
-        _logger.info(f"Loading index #{self._index_num}...")
-        
-        pkl, version = self._db.load_index(self._index_num)   
-        
-        if pkl == None:
-            _logger.info("No index found.")
-        else:
-            self.index = pickle.loads(pkl)
-            _logger.info(f"Done loading index #{self._index_num}.")
+        with self._write_lock:
+            self.__begin(IndexStatus.LOADING, IndexSubStatus.LOADING)
+            try:
+                _logger.info(f"Loading index #{self._index_num}...")
+                
+                index, version = self.__load_snapshot()
+                mapped = index is not None and self._configuration["SNAPSHOT_CACHE"]["MMAP"]
+                if (index is None):
+                    data, version, format = self._db.load_index(self._index_num, self.__read_index)   
+                    
+                    if data is None:
+                        _logger.info("No index found.")
+                    else:
+                        index = pickle.loads(data) if format == IndexFormat.PICKLE else data
+                        if (isinstance(index, list)):
+                            index = new_index_shards(index)
+                        self.__write_snapshot(index, version)
 
-        if (self.index):
-            self._data_version = version
-            self._saved_data_version = version
-            self.status = IndexStatus.TRAINED
-            self.substatus = IndexSubStatus.READY
-        else:
-            self._data_version = 0
-            self._saved_data_version = 0
-            self.status = IndexStatus.NOINDEX
+                metadata = None
+                if (index):
+                    self._check_metric(index)
+                    index, mapped, version, log_items = self.__replay_log(index, mapped, version)
+                    self._set_search_parameters(index)
+                    metadata = self.__load_metadata()
+                    _logger.info(f"Done loading index #{self._index_num}.")
+            except:
+                self.__rollback()
+                raise
+
+            if (index):
+                self._factory = self.__get_loaded_factory(index)
+                self.__swap(index, version, version, metadata, mapped)
+                self._journal.on_full_save(log_items)
+            elif (self.index is None):
+                self._data_version = 0
+                self._saved_data_version = 0
+                self.status = IndexStatus.NOINDEX
+                self.substatus = IndexSubStatus.NONE
+            else:
+                self.__rollback()
+
+    def unload(self):
+        with self._write_lock:
+            if (self.__has_unsaved_changes()):
+                _logger.info(f"Index #{self._index_num} has unsaved changes, skipping unload request.")
+                return
+
+            with self._lock.write():
+                self.index = None
+                self._metadata = self.__new_metadata()
+            self.status = IndexStatus.UNLOADED
             self.substatus = IndexSubStatus.NONE
+            _logger.info(f"Unloaded index #{self._index_num}.")
+
+    def get_memory_usage(self) -> int:
+        index = self.index
+        if (index is None):
+            return 0
+
+        base_index = self._get_base_index(index)
+        # codes plus ids, and level 0 links for HNSW which dominate its graph size
+        vector_size = self._get_code_size(index) + 8
+        if (isinstance(base_index, faiss.IndexHNSW)):
+            vector_size += base_index.hnsw.nb_neighbors(0) * 4
+        return index.ntotal * vector_size
+
+    def _get_code_size(self, index:faiss.Index) -> int:
+        index = faiss.downcast_index(index)
+        if (isinstance(index, faiss.IndexShards)):
+            return self._get_code_size(index.at(0))
+        if (isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2))):
+            return self._get_code_size(index.index)
+        if (isinstance(index, faiss.IndexRefine)):
+            return self._get_code_size(index.base_index) + self._get_code_size(index.refine_index)
+        if (isinstance(index, faiss.IndexHNSW)):
+            return self._get_code_size(index.storage)
+        try:
+            return index.sa_code_size()
+        except RuntimeError:
+            return index.d * 4
 
     def save(self):
-        if not (self.status == IndexStatus.TRAINED and 
-            self.substatus == IndexSubStatus.READY and
-            self._data_version != self._saved_data_version):
-            _logger.info("Index already saved and no changes detected, skipping save request.")
-            return
-        
-        _logger.info(f"Saving index #{self._index_num}...")
-        self.substatus = IndexSubStatus.SAVING
-        pkl = pickle.dumps(self.index)
-        self._db.save_index(
-            self._index_num, 
-            pkl, 
-            self.index.ntotal, 
-            self.index.d, 
-            self._data_version)
-        self._saved_data_version = self._data_version
-        self.substatus = IndexSubStatus.READY
-        _logger.info(f"Done saving index #{self._index_num}.")
+        with self._write_lock:
+            if not (self.status == IndexStatus.TRAINED and 
+                self.substatus == IndexSubStatus.READY and
+                self.__has_unsaved_changes()):
+                _logger.info("Index already saved and no changes detected, skipping save request.")
+                return
+            
+            _logger.info(f"Saving index #{self._index_num}...")
+            self.substatus = IndexSubStatus.SAVING
+            # index can't change while the write lock is held, so queries can keep running while it's saved
+            try:
+                if (self._journal.use_log()):
+                    # only the changes applied since the last save are written, they're replayed on load
+                    _logger.info(f"Saving {self._journal.get_pending_items()} changes to the index log...")
+                    self._db.append_index_log(self._index_num, self._journal.entries)
+                    self._journal.on_log_saved()
+                else:
+                    self.__save_index()
+                    self._journal.on_full_save()
+                    self.__write_snapshot(self.index, self._data_version)
+                self._saved_data_version = self._data_version
+            finally:
+                self.substatus = IndexSubStatus.READY
+            _logger.info(f"Done saving index #{self._index_num}.")
+
+    def __save_index(self):
+        if (self._configuration["PERSISTENCE"]["FORMAT"] == IndexFormat.PICKLE):
+            self._db.save_index(
+                self._index_num, 
+                pickle.dumps(get_shards(self.index) if is_sharded(self.index) else self.index), 
+                self.index.ntotal, 
+                self.index.d, 
+                self._data_version)
+        else:
+            self._db.save_index_chunks(
+                self._index_num, 
+                self.__write_index, 
+                self.index.ntotal, 
+                self.index.d, 
+                self._data_version)
 
     def update(self) -> UpdateResult:
         if (self.status != IndexStatus.TRAINED):
             return UpdateResult.INDEX_NOT_READY
 
-        #print(f"Checking for changes from version {from_version}...")
-        #version, type, reason, changes = mf.update_index_with_ct(self._data_version)    
+        # most polls find nothing, which only takes reading the current version
+        if (self._db.get_current_version() == self._data_version):
+            return UpdateResult.NO_CHANGES
 
-        change_info = self._db.get_changes(self._data_version)    
-        version = int(change_info["Metadata"]["Sync"]["Version"])
-        type = change_info["Metadata"]["Sync"]["Type"]
-        reason = change_info["Metadata"]["Sync"]["ReasonCode"]
-        changes = change_info.get("Data")
-            
-        if (type == "Diff"):        
-            _logger.info(f"Found new version. Updating index to {version}...")        
-            for c in changes:
-                id = int(c["id"])            
-                operation = c["$operation"]            
-                _logger.debug(f"Id={id}, Op={operation}")
-                match operation:
-                    case "I":
-                        vector = json.loads(c["vector"])
-                        self.index.add_with_ids(np.asarray([vector]), np.asarray([id]))
-                    case "D":
-                        self.index.remove_ids(np.asarray([id]))
-                    case "U":
-                        vector = json.loads(c["vector"])
-                        self.index.remove_ids(np.asarray([id]))
-                        self.index.add_with_ids(np.asarray([vector]), np.asarray([id]))
-                    case _:
-                        raise Exception(f"Unknown operation: {operation}")
-
-            self._data_version = version
-            _logger.info(f"Done. New version is {version}.")     
-            return UpdateResult.DONE
+        # a rebuild, load or save is in progress, changes will be picked up on the next run
+        if (not self._write_lock.acquire(blocking=False)):
+            return UpdateResult.INDEX_BUSY
+
+        try:
+            self._shadow_index = None
+            try:
+                sync = self._db.stream_changes(self._data_version, self._apply_changes)
+            except IndexIsStaleError as e:
+                _logger.warning(str(e))
+                return UpdateResult.INDEX_IS_STALE
+            version = int(sync["Version"])
+            type = sync["Type"]
+            reason = sync["ReasonCode"]
+                
+            if (type == "Diff"):        
+                if (self._shadow_index is not None):
+                    _logger.info("Swapping in updated shadow index...")
+                    with self._lock.write():
+                        self.index = self._shadow_index
+                self._data_version = version
+                self._journal.commit(version)
+                self._cache.clear()
+                if (sync.get("Partial")):
+                    _logger.info(f"Done with a batch of changes, more are pending. New version is {version}.")
+                    return UpdateResult.PARTIAL
+                _logger.info(f"Done. New version is {version}.")     
+                return UpdateResult.DONE
+            else:
+                if (reason != 1):
+                    match reason:
+                        case 2:
+                            return UpdateResult.INDEX_IS_STALE
+                        case _:
+                            return UpdateResult.UNKNOWN
+                else:
+                    return UpdateResult.NO_CHANGES
+        finally:
+            self._shadow_index = None
+            self._journal.discard()
+            self._write_lock.release()
+
+    def _apply_changes(self, changes:list[dict]):
+        if (not self._can_remove_ids(self.index) and any([c["$operation"] != "I" for c in changes])):
+            # vectors can't be removed from HNSW graphs, the index has to be built again
+            raise IndexIsStaleError(f"Index #{self._index_num} can't remove vectors, updates and deletes need it to be created again.")
+        if (self._mapped):
+            index = self.__read_in_memory(self.index)
+            with self._lock.write():
+                self.index = index
+            self._mapped = False
+
+        # large batches are applied to a copy of the index, so that queries don't wait for them
+        threshold = self._configuration["FAISS"].get("SHADOW_UPDATE_THRESHOLD")
+        if (self._shadow_index is None and threshold and len(changes) >= threshold):
+            _logger.info("Large batch of changes, applying them to a shadow index...")
+            with self._lock.read():
+                self._shadow_index = clone_index_shards(self.index)
+
+        # changes are parsed before taking the lock, queries only wait while the index itself changes
+        final, removed_ids, ids, vectors = self._prepare_changes(self.index, changes)
+        if (len(final) == 0):
+            return
+        if (self._shadow_index is not None):
+            self._apply_delta(self._shadow_index, removed_ids, ids, vectors)
+        else:
+            with self._lock.write():
+                self._apply_delta(self.index, removed_ids, ids, vectors)
+        self._journal.add(removed_ids, ids, vectors)
+        self._metadata.apply(final)
+
+    def _prepare_changes(self, index:faiss.Index, changes:list[dict]):
+        # collapse changes to the final state of each id, so that every id is touched once
+        final = {}
+        for c in sorted(changes, key=lambda c: int(c["$version"])):
+            if (c["$operation"] not in ("I", "U", "D")):
+                raise Exception(f"Unknown operation: {c['$operation']}")
+            final[int(c["id"])] = c
+
+        if (len(final) == 0):
+            return final, None, None, None
+
+        # inserts are removed too, so that replaying a change already in the index doesn't duplicate it,
+        # except on indexes that can't remove vectors (HNSW), where only updates and deletes fail
+        removed = final.keys() if self._can_remove_ids(index) else [id for id, c in final.items() if c["$operation"] != "I"]
+        removed_ids = np.fromiter(removed, dtype=np.int64, count=len(removed))
+        upserts = [(id, c["vector"]) for id, c in final.items() if c["$operation"] != "D" and c.get("vector") is not None]
+        _logger.info(f"Applying {len(final)} changes ({len(upserts)} inserts or updates)...")
+
+        ids = vectors = None
+        if (len(upserts) > 0):
+            ids = np.fromiter([u[0] for u in upserts], dtype=np.int64, count=len(upserts))
+            vectors = self._normalize(self._db.parse_changed_vectors([u[1] for u in upserts]))
+        return final, removed_ids, ids, vectors
+
+    def _apply_delta(self, index:faiss.Index, removed_ids:np.ndarray, ids:np.ndarray, vectors:np.ndarray):
+        if (len(removed_ids) > 0):
+            remove_ids(index, removed_ids)
+        if (ids is not None):
+            add_with_ids(index, ids, vectors)
+
+    def __replay_log(self, index:faiss.Index, mapped:bool, version:int):
+        last_version = version
+        def on_entry(data_version:int, data:bytes):
+            nonlocal index, mapped, last_version
+            if (mapped):
+                index = self.__read_in_memory(index)
+                mapped = False
+            for removed_ids, ids, vectors in ChangeJournal.deserialize(data):
+                self._apply_delta(index, removed_ids, ids, vectors)
+            last_version = data_version
+
+        items = self._db.load_index_log(self._index_num, version, on_entry)
+        if (last_version != version):
+            _logger.info(f"Replayed {items} changes from the index log, from version {version} to {last_version}.")
+        return index, mapped, last_version, items
+
+    def __read_in_memory(self, index:faiss.Index) -> faiss.Index:
+        # memory mapped codes can't grow or shrink, changing them in place aborts the process
+        _logger.info("Reading memory mapped index in memory before changing it...")
+        return copy_index_shards(index)
+
+    def __new_metadata(self) -> MetadataStore:
+        return MetadataStore(self._configuration.get("METADATA", {}).get("COLUMNS", {}))
+
+    def __load_metadata(self) -> MetadataStore:
+        metadata = self.__new_metadata()
+        if (metadata.enabled):
+            _logger.info("Loading metadata...")
+            self._db.stream_metadata_from_db(metadata.add)
+            metadata.finish()
+        return metadata
+
+    def __load_snapshot(self):
+        if (self._snapshot_cache is None):
+            return None, 0
+
+        version = self._snapshot_cache.get_version()
+        if (version is None):
+            return None, 0
+
+        saved_version = self._db.get_index_version(self._index_num)
+        if (version != saved_version):
+            _logger.info(f"Index snapshot is at version {version}, saved index is at version {saved_version}.")
+            return None, 0
+
+        return self._snapshot_cache.read(self._configuration["SNAPSHOT_CACHE"]["MMAP"]), version
+
+    def __write_snapshot(self, index:faiss.Index, data_version:int):
+        if (self._snapshot_cache is None):
+            return
+
+        # the database copy is the source of truth, a missing snapshot only makes the next load slower
+        try:
+            self._snapshot_cache.write(index, data_version)
+        except Exception as e:
+            _logger.warning(f"Unable to write index snapshot: {e}")
+
+    def __write_index(self, write):
+        write_index_shards(self.index, write, self.__get_io_block_size())
+
+    def __read_index(self, read) -> faiss.Index:
+        return read_index_shards(read, self.__get_io_block_size())
+
+    def __get_io_block_size(self) -> int:
+        return self._configuration["PERSISTENCE"]["CHUNK_SIZE_MB"] * 1024 * 1024
+
+    def __get_loaded_factory(self, index:faiss.Index) -> str:
+        # saved indexes don't keep their factory string, it's rebuilt from their structure (shards are all alike)
+        try:
+            return reverse_index_factory(get_shards(index)[0])
+        except Exception:
+            return None
+
+    def __get_exact_filter_max_ids(self) -> int:
+        return self._configuration["FAISS"].get("EXACT_FILTER_MAX_IDS") or 0
+
+    def __has_unsaved_changes(self) -> bool:
+        # a new index needs a full save even when its data version matches the saved one
+        return self._data_version != self._saved_data_version or self._journal.full_save_required
+
+    def __begin(self, status:IndexStatus, substatus:IndexSubStatus):
+        # an existing index keeps serving queries until the new one is swapped in
+        if (self.index is None):
+            self.status = status
+            self.substatus = IndexSubStatus.NONE
+        else:
+            self.substatus = substatus
+
+    def __rollback(self):
+        if (self.index is None):
+            self.status = IndexStatus.NOINDEX
+        self.substatus = IndexSubStatus.READY if self.index else IndexSubStatus.NONE
+
+    def __swap(self, index:faiss.Index, data_version:int, saved_data_version:int, metadata:MetadataStore = None, mapped:bool = False):
+        with self._lock.write():
+            self.index = index
+            self._mapped = mapped
+            if (metadata is not None):
+                self._metadata = metadata
+            self._data_version = data_version
+            self._saved_data_version = saved_data_version
+        self._cache.clear()
+        self.status = IndexStatus.TRAINED
+        self.substatus = IndexSubStatus.READY
+
+    def query(self, vector:list[float], limit:int, options:SearchOptions = None):
+        return {"result": self._query([vector], limit, options or SearchOptions())[0]}
+
+    def query_batch(self, vectors:list[list[float]], limit:int, options:SearchOptions = None):
+        return {"result": self._query(vectors, limit, options or SearchOptions())}
+
+    def _query(self, vectors:list[list[float]], limit:int, options:SearchOptions) -> list[dict]:
+        qv = self._normalize(np.ascontiguousarray(vectors, dtype=np.float32))
+        if (not self._cache.enabled):
+            dist, ids = self._search(qv, limit, options)
+            return [self._get_result(dist[i], ids[i]) for i in range(len(ids))]
+
+        # results are cached by data version too, so they can't be served once the index changed
+        data_version = self._data_version
+        keys = [self._cache.get_key(v, limit, data_version, options) for v in qv]
+        results = [self._cache.get(k) for k in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if (len(missing) > 0):
+            dist, ids = self._search(qv[missing], limit, options)
+            for j, i in enumerate(missing):
+                results[i] = self._get_result(dist[j], ids[j])
+                self._cache.put(keys[i], results[i])
+        return results
+
+    def _search(self, vectors:np.ndarray, limit:int, options:SearchOptions):
+        qv = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock.read():
+            index = self.index
+            if (qv.ndim != 2 or qv.shape[1] != index.d):
+                raise ValueError(f"Query vectors must have {index.d} dimensions.")
+            allowed_ids = self._get_allowed_ids(options)
+            if (allowed_ids is not None and len(allowed_ids) <= self.__get_exact_filter_max_ids() and self._can_search_exact(index)):
+                return self._search_exact(index, qv, limit, allowed_ids, options)
+            params = self._get_request_search_parameters(index, options, allowed_ids)
+            try:
+                if (options.threshold is None):
+                    return index.search(qv, limit, params=params)
+                return self._range_search(index, qv, limit, params, self._get_radius(options.threshold))
+            except RuntimeError as e:
+                # some index types (eg: PQ) don't accept search parameters at all
+                if (params is None):
+                    raise
+                raise ValueError(f"Search options are not supported by {type(self._get_base_index(index)).__name__} indexes.") from e
+
+    def _range_search(self, index:faiss.Index, qv:np.ndarray, limit:int, params, radius:float):
+        # faiss range_search returns every vector in range, the whole index for a loose threshold, so results
+        # are the top k cut at the radius instead
+        dist, ids = index.search(qv, limit, params=params)
+        return dist, self._cut_at_radius(dist, ids, radius)
+
+    def _cut_at_radius(self, dist:np.ndarray, ids:np.ndarray, radius:float) -> np.ndarray:
+        ids[(dist >= radius) if self._is_l2() else (dist <= radius)] = -1
+        return ids
+
+    def _get_allowed_ids(self, options:SearchOptions) -> np.ndarray:
+        ids = options.ids
+        if (options.predicates):
+            # predicates on metadata columns become one more id list, matched before the search
+            ids = self._metadata.evaluate(options.predicates)
+            if (options.ids is not None):
+                ids = np.intersect1d(ids, np.asarray(options.ids, dtype=np.int64))
+        if (ids is None):
+            return None
+        return np.unique(np.asarray(ids, dtype=np.int64))
+
+    def _can_search_exact(self, index:faiss.Index) -> bool:
+        # IVF and flat indexes already scan every allowed vector, HNSW graphs lose most of them
+        return (isinstance(self._get_base_index(index), faiss.IndexHNSW) and
+            all([isinstance(s, faiss.IndexIDMap) for s in get_shards(index)]))
+
+    def _search_exact(self, index:faiss.Index, qv:np.ndarray, limit:int, allowed_ids:np.ndarray, options:SearchOptions):
+        if (options.exclude_ids):
+            allowed_ids = allowed_ids[~np.isin(allowed_ids, np.asarray(options.exclude_ids, dtype=np.int64))]
+        if (options.id_ranges):
+            allowed_ids = allowed_ids[np.any([(allowed_ids >= r[0]) & (allowed_ids < r[1]) for r in options.id_ranges], axis=0)]
+
+        ids = []
+        vectors = []
+        for shard in get_shards(index):
+            id_map = faiss.rev_swig_ptr(shard.id_map.data(), shard.id_map.size())
+            positions = np.flatnonzero(np.isin(id_map, allowed_ids))
+            # refine indexes keep a full precision copy of the vectors, the others are decoded from their codes
+            refine = self._get_refine_index(shard)
+            source = refine.refine_index if refine is not None else shard.index
+            ids.append(id_map[positions])
+            vectors.append(source.reconstruct_batch(positions))
+        ids = np.concatenate(ids)
+        vectors = np.concatenate(vectors)
+
+        dist = np.full((len(qv), limit), np.inf if self._is_l2() else -np.inf, dtype=np.float32)
+        result = np.full((len(qv), limit), -1, dtype=np.int64)
+        k = min(limit, len(ids))
+        if (k > 0):
+            d, i = faiss.knn(qv, vectors, k, metric=faiss.METRIC_L2 if self._is_l2() else faiss.METRIC_INNER_PRODUCT)
+            dist[:, :k] = d
+            result[:, :k] = np.where(i >= 0, ids[i], -1)
+        if (options.threshold is not None):
+            result = self._cut_at_radius(dist, result, self._get_radius(options.threshold))
+        return dist, result
+
+    def _get_request_search_parameters(self, index:faiss.Index, options:SearchOptions, ids:np.ndarray = None):
+        if (options.nprobe is None and options.ef_search is None and not options.has_filter()):
+            return None
+
+        base_index = self._get_base_index(index)
+        is_ivf = faiss.try_extract_index_ivf(base_index) is not None
+        is_hnsw = isinstance(base_index, faiss.IndexHNSW)
+        if (options.nprobe is not None and not is_ivf):
+            raise ValueError("nprobe is only supported by IVF indexes.")
+        if (options.ef_search is not None and not is_hnsw):
+            raise ValueError("efSearch is only supported by HNSW indexes.")
+
+        # the fewer vectors pass the filter, the more of the index has to be searched to find k of them
+        fraction = min(1, len(ids) / max(index.ntotal, 1)) if ids is not None else 1
+        selector, references = get_id_selector(ids, options.exclude_ids, options.id_ranges)
+        refine = self._get_refine_index(index)
+        if (selector is not None and refine is not None and is_sharded(index)):
+            # ids have to be translated to the internal ids of each shard, while all shards get the same parameters
+            raise ValueError("Filters are not supported by sharded indexes with REFINE.")
+
+        if (is_ivf):
+            params = faiss.SearchParametersIVF()
+            ivf = faiss.try_extract_index_ivf(base_index)
+            if (options.nprobe is not None):
+                params.nprobe = options.nprobe
+            elif (ids is not None and len(ids) <= self.__get_exact_filter_max_ids()):
+                # all lists are scanned, only the few allowed vectors are scored
+                params.nprobe = ivf.nlist
+            else:
+                params.nprobe = min(ivf.nlist, math.ceil(ivf.nprobe / max(fraction, 1e-9)))
+        elif (is_hnsw):
+            params = faiss.SearchParametersHNSW()
+            params.efSearch = options.ef_search if options.ef_search is not None else base_index.hnsw.efSearch
+            if (options.ef_search is None and fraction < 1):
+                params.efSearch = max(params.efSearch, min(index.ntotal, math.ceil(params.efSearch / max(fraction, 1e-9))))
         else:
-            if (reason != 1):
-                match reason:
-                    case 2:
-                        return UpdateResult.INDEX_IS_STALE
-                    case _:
-                        return UpdateResult.UNKNOWN
+            params = faiss.SearchParameters()
+
+        if (selector is not None):
+            if (refine is not None and isinstance(faiss.downcast_index(index), faiss.IndexIDMap)):
+                # IndexRefine only passes the base index parameters down, where ids are the internal ones
+                selector = faiss.IDSelectorTranslated(faiss.downcast_index(index).id_map, selector)
+                references.append(selector)
+            params.sel = selector
+        # selectors only hold pointers, so the python objects must live as long as the parameters
+        params.referenced_objects = references
+
+        if (refine is not None):
+            refine_params = faiss.IndexRefineSearchParameters()
+            refine_params.k_factor = refine.k_factor
+            refine_params.base_index_params = params
+            refine_params.referenced_objects = [params]
+            return refine_params
+        return params
+
+    def _get_result(self, dist, ids):
+        r = dict(zip([int(i) for i in ids if i != -1], self._get_distance(dist[ids != -1])))
+        return json.loads(json.dumps(r, cls=NpEncoder))
+
+    def _get_distance(self, dist:np.ndarray) -> np.ndarray:
+        # results are always distances (lower is closer): 1 - cosine similarity for COSINE, 1 - inner product for IP
+        # and euclidean distance for L2 (FAISS returns it squared)
+        if (self._is_l2()):
+            return np.sqrt(np.maximum(dist, 0))
+        return 1 - dist
+
+    def _get_radius(self, threshold:float) -> float:
+        if (self._is_l2()):
+            return threshold * threshold
+        return 1 - threshold
+
+    def _normalize(self, vectors:np.ndarray) -> np.ndarray:
+        if (self._get_metric() != "COSINE"):
+            return vectors
+        # vectors parsed from binary rows are read only views
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if (not vectors.flags.writeable):
+            vectors = vectors.copy()
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _can_remove_ids(self, index:faiss.Index) -> bool:
+        return not isinstance(self._get_base_index(index), faiss.IndexHNSW)
+
+    def _get_metric(self) -> str:
+        return self._configuration["FAISS"].get("METRIC", "IP")
+
+    def _check_metric(self, index:faiss.Index):
+        # distances and thresholds only mean what METRIC says if the index was built with it
+        metric = self._get_metric()
+        index_metric = "L2" if get_shards(index)[0].metric_type == faiss.METRIC_L2 else "IP"
+        if ((metric == "L2") != (index_metric == "L2")):
+            raise Exception(f"Index #{self._index_num} was built with the {index_metric} metric, but METRIC is {metric}. Create the index again or change METRIC.")
+        if (metric == "COSINE" and not self._is_normalized(index)):
+            raise Exception(f"Index #{self._index_num} holds vectors that are not normalized, but METRIC is COSINE. Create the index again or change METRIC.")
+
+    def _is_normalized(self, index:faiss.Index, sample_size:int = 100) -> bool:
+        base_index = self._get_base_index(index)
+        if (base_index.ntotal == 0):
+            return True
+        ivf = faiss.try_extract_index_ivf(base_index)
+        try:
+            if (ivf is not None):
+                # IVF vectors are reconstructed by id, so the sample is read from the largest list
+                list_no = max(range(ivf.nlist), key=ivf.invlists.list_size)
+                n = min(ivf.invlists.list_size(list_no), sample_size)
+                vectors = np.empty((n, ivf.d), dtype=np.float32)
+                for o in range(n):
+                    ivf.reconstruct_from_offset(list_no, o, faiss.swig_ptr(vectors[o]))
             else:
-                return UpdateResult.NO_CHANGES
+                vectors = base_index.reconstruct_n(0, min(base_index.ntotal, sample_size))
+        except RuntimeError:
+            # the vectors can't be read back from some index types, the metric type check has to do
+            return True
+        norms = np.linalg.norm(vectors, axis=1)
+        norms = norms[norms > 0]
+        # SQ and PQ codes only approximate the vectors
+        return len(norms) == 0 or abs(float(np.median(norms)) - 1) < 0.05
+
+    def _is_l2(self) -> bool:
+        return self._get_metric() == "L2"
+
+    def _get_factory_string(self) -> str:
+        c = self._configuration["FAISS"]
+        if (c.get("FACTORY")):
+            return c["FACTORY"]
 
+        storage = self._get_storage_string()
+        match c["TYPE"]:
+            case "FLAT":
+                factory = f"IDMap,{storage}"
+            case "IVF":
+                factory = f"IVF{c['NLIST']},{storage}"
+            case "HNSW":
+                factory = f"IDMap,HNSW{c['HNSW_M']}" if storage == "Flat" else f"IDMap,HNSW{c['HNSW_M']}_{storage}"
+            case "PQ":
+                factory = f"IDMap,PQ{c['PQ_M']}"
+            case "IVFPQ":
+                factory = f"IVF{c['NLIST']},PQ{c['PQ_M']}"
+            case _:
+                raise Exception(f"Unknown index type: {c['TYPE']}")
 
-    def query(self, vector:list[float], limit:int):
-        qv = np.asarray([vector])
-        dist, ids = self.index.search(qv, limit)
-        r = dict(zip([int(i) for i in ids[0]], 1-dist[0]))
-        return {"result": json.loads(json.dumps(r, cls=NpEncoder))}
+        if (c.get("REFINE")):
+            # IndexRefine assigns sequential ids, so it always needs an id map on top
+            if (not factory.startswith("IDMap,")):
+                factory = f"IDMap,{factory}"
+            factory += ",RFlat"
+        return factory
+
+    def _get_storage_string(self) -> str:
+        c = self._configuration["FAISS"]
+        match c.get("STORAGE", "FLOAT32"):
+            case "FLOAT32":
+                return "Flat"
+            case "FP16":
+                return "SQfp16"
+            case "SQ8":
+                return "SQ8"
+            case "PQ":
+                return f"PQ{c['PQ_M']}"
+            case _:
+                raise Exception(f"Unknown storage type: {c['STORAGE']}")
+
+    def _new_builder(self, d:int):
+        c = self._configuration["FAISS"]
+        self._factory = self._get_factory_string()
+        shards = c.get("SHARDS") or 1
+        _logger.info(f"Using factory string '{self._factory}'" + (f" for {shards} shards." if shards > 1 else "."))
+        if (shards > 1):
+            return ShardedIndexBuilder([self._build_index(d) for _ in range(shards)], c["TRAINING_SAMPLE"])
+        return IndexBuilder(self._build_index(d), c["TRAINING_SAMPLE"])
+
+    def _build_index(self, d:int) -> faiss.Index:
+        metric = faiss.METRIC_L2 if self._is_l2() else faiss.METRIC_INNER_PRODUCT
+        index = faiss.index_factory(d, self._factory, metric)
+        # some factory strings ignore the metric (eg: HNSW_PQ is always L2), results would be ranked by the wrong one
+        if (index.metric_type != metric or self._get_base_index(index).metric_type != metric):
+            raise Exception(f"Factory string '{self._factory}' doesn't support the {self._get_metric()} metric.")
+        return index
+
+    def _set_search_parameters(self, index:faiss.Index):
+        ps = faiss.ParameterSpace()
+        for shard in get_shards(index):
+            base_index = self._get_base_index(shard)
+            if (faiss.try_extract_index_ivf(base_index) is not None):
+                ps.set_index_parameter(shard, "nprobe", self._configuration["FAISS"]["NPROBE"])
+            if (isinstance(base_index, faiss.IndexHNSW)):
+                ps.set_index_parameter(shard, "efSearch", self._configuration["FAISS"]["EF_SEARCH"])
+            refine = self._get_refine_index(shard)
+            if (refine is not None):
+                refine.k_factor = self._configuration["FAISS"].get("REFINE_K_FACTOR", 1)
+
+    def _get_search_parameters(self, index:faiss.Index):
+        base_index = self._get_base_index(index)
+        refine = self._get_refine_index(index)
+        result = {"k_factor": refine.k_factor} if refine is not None else {}
+        ivf = faiss.try_extract_index_ivf(base_index)
+        if (ivf is not None):
+            result.update({"nprobe": ivf.nprobe, "nlist": ivf.nlist})
+        if (isinstance(base_index, faiss.IndexHNSW)):
+            result.update({"efSearch": base_index.hnsw.efSearch, "M": base_index.hnsw.nb_neighbors(1)})
+        return result
+
+    def _get_base_index(self, index:faiss.Index) -> faiss.Index:
+        # shards are all built the same way, the first one stands for all of them
+        index = get_shards(index)[0]
+        while (isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexRefine))):
+            index = faiss.downcast_index(index.base_index if isinstance(index, faiss.IndexRefine) else index.index)
+        return index
+
+    def _get_refine_index(self, index:faiss.Index) -> faiss.IndexRefine:
+        index = get_shards(index)[0]
+        while (isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2))):
+            index = faiss.downcast_index(index.index)
+        return index if isinstance(index, faiss.IndexRefine) else None
 
     def get_status(self):
         if (self.index):
             return {
                 "id": self._index_num,
                 "type": type(self.index).__name__,
+                "index_type": type(self._get_base_index(self.index)).__name__,
+                "factory": self._factory,
+                "shards": len(get_shards(self.index)),
+                "metric": self._get_metric(),
+                "search_parameters": self._get_search_parameters(self.index),
                 "status": self.status,
                 "substatus": self.substatus,
                 "data_version": self._data_version,
                 "saved_data_version": self._saved_data_version,
                 "dimensions": self.index.d,
-                "vectors": self.index.ntotal
+                "vectors": self.index.ntotal,
+                "bytes_per_vector": self._get_code_size(self.index),
+                "memory_usage": self.get_memory_usage(),
+                "cache": self._cache.get_status(),
+                "journal": self._journal.get_status() if self._journal.enabled else None,
+                "database": self._db.get_pool_status(),
+                "metadata": self._metadata.get_status() if self._metadata.enabled else None,
+                "build": self._build.get_status()
             }
         else:
             return {
                 "id": self._index_num,
                 "status": self.status,
                 "substatus": self.substatus,
-                "data_version": self._data_version
+                "data_version": self._data_version,
+                "build": self._build.get_status()
             }
     
     def get_version(self):
@@ -1,10 +1,10 @@
 from .utils import IndexStatus, IndexSubStatus
 
 class BaseIndex:
-    def __init__(self) -> None:
+    def __init__(self, index_num:int = 1) -> None:
         self.status:IndexStatus = IndexStatus.NOT_READY
         self.substatus:IndexSubStatus = IndexSubStatus.NONE
-        self._index_num:int = 1
+        self._index_num:int = index_num
  
     def create(self):
         pass
@@ -15,6 +15,12 @@ class BaseIndex:
     def load(self): 
         pass
 
+    def unload(self):
+        pass
+
+    def get_memory_usage(self) -> int:
+        return 0
+
     def get_status(self):
         return {
             "id": self._index_num,
@@ -23,6 +29,6 @@ class BaseIndex:
         }
         
 class NoIndex(BaseIndex):
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, index_num:int = 1) -> None:
+        super().__init__(index_num)
     
\ No newline at end of file
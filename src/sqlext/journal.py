@@ -0,0 +1,95 @@
+import io
+import time
+import numpy as np
+
+class ChangeJournal:
+    def __init__(self, max_items:int, full_save_minutes:int, compression:str) -> None:
+        self._max_items = max_items or 0
+        self._full_save_seconds = (full_save_minutes or 0) * 60
+        self._compression = compression
+        # deltas of the update in progress, they become an entry once it's done
+        self._deltas = []
+        # entries not saved yet, as (data_version, item_count, data)
+        self.entries = []
+        self.saved_items = 0
+        self.full_save_required = True
+        self._full_save_time = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_items > 0
+
+    def add(self, removed_ids:np.ndarray, ids:np.ndarray, vectors:np.ndarray):
+        if (self.enabled):
+            self._deltas.append((removed_ids, ids, vectors))
+
+    def commit(self, data_version:int):
+        deltas = self._deltas
+        self._deltas = []
+        if (self.enabled and len(deltas) > 0):
+            self.entries.append((data_version, sum([len(d[0]) for d in deltas]), self.__serialize(deltas)))
+
+    def discard(self):
+        self._deltas = []
+
+    def get_pending_items(self) -> int:
+        return sum([e[1] for e in self.entries])
+
+    def use_log(self) -> bool:
+        # the log is only worth replaying on load while it stays small compared to a full save
+        return (self.enabled and
+            not self.full_save_required and
+            self.saved_items + self.get_pending_items() <= self._max_items and
+            (self._full_save_seconds == 0 or time.monotonic() - self._full_save_time < self._full_save_seconds))
+
+    def on_log_saved(self):
+        self.saved_items += self.get_pending_items()
+        self.entries = []
+
+    def on_full_save(self, saved_items:int = 0):
+        self.entries = []
+        self.saved_items = saved_items
+        self.full_save_required = False
+        self._full_save_time = time.monotonic()
+
+    def reset(self):
+        # a new index has nothing in common with the saved one
+        self._deltas = []
+        self.entries = []
+        self.saved_items = 0
+        self.full_save_required = True
+
+    def get_status(self):
+        return {
+            "pending_items": self.get_pending_items(),
+            "saved_items": self.saved_items,
+            "max_items": self._max_items,
+            "full_save_required": self.full_save_required
+        }
+
+    def __serialize(self, deltas:list[tuple]) -> bytes:
+        arrays = {}
+        for i, (removed_ids, ids, vectors) in enumerate(deltas):
+            arrays[f"removed_{i}"] = removed_ids
+            if (ids is not None):
+                arrays[f"ids_{i}"] = ids
+                arrays[f"vectors_{i}"] = vectors
+        buffer = io.BytesIO()
+        if (self._compression == "ZLIB"):
+            np.savez_compressed(buffer, **arrays)
+        else:
+            np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @staticmethod
+    def deserialize(data:bytes) -> list[tuple]:
+        deltas = []
+        with np.load(io.BytesIO(data)) as arrays:
+            i = 0
+            while (f"removed_{i}" in arrays):
+                if (f"ids_{i}" in arrays):
+                    deltas.append((arrays[f"removed_{i}"], arrays[f"ids_{i}"], arrays[f"vectors_{i}"]))
+                else:
+                    deltas.append((arrays[f"removed_{i}"], None, None))
+                i += 1
+        return deltas
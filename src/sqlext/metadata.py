@@ -0,0 +1,154 @@
+import logging
+import threading
+import numpy as np
+
+_logger = logging.getLogger("uvicorn")
+
+# NUMBER columns are stored as float64 (NaN for nulls), DATE as datetime64 (NaT for nulls)
+# and STRING as dictionary codes (-1 for nulls)
+COLUMN_TYPES = ("NUMBER", "DATE", "STRING")
+
+class MetadataStore:
+    def __init__(self, columns:dict[str, str]) -> None:
+        for name, type in columns.items():
+            if (type not in COLUMN_TYPES):
+                raise Exception(f"Unknown metadata column type for {name}: {type}")
+
+        self._columns = columns
+        self._lock = threading.Lock()
+        self._ids = np.empty((0), dtype=np.int64)
+        self._values = {name: self.__empty(name) for name in columns}
+        self._dictionaries:dict[str, dict[str, int]] = {name: {} for name, type in columns.items() if type == "STRING"}
+        self._chunks = []
+
+    @property
+    def enabled(self) -> bool:
+        return len(self._columns) > 0
+
+    def get_columns(self) -> list[str]:
+        return list(self._columns.keys())
+
+    def add(self, ids:np.ndarray, metadata:dict[str, list]):
+        # chunks are sorted and merged once, when loading is done
+        with self._lock:
+            self._chunks.append((np.asarray(ids, dtype=np.int64), {name: self.__encode(name, metadata[name]) for name in self._columns}))
+
+    def finish(self):
+        with self._lock:
+            chunks = self._chunks
+            self._chunks = []
+            if (len(chunks) == 0):
+                return
+            ids = np.concatenate([self._ids] + [c[0] for c in chunks])
+            values = {name: np.concatenate([self._values[name]] + [c[1][name] for c in chunks]) for name in self._columns}
+            self.__set(ids, values)
+            _logger.info(f"Loaded metadata for {len(self._ids)} rows.")
+
+    def apply(self, changes:dict[int, dict]):
+        if (len(changes) == 0):
+            return
+
+        changed_ids = np.fromiter(changes.keys(), dtype=np.int64, count=len(changes))
+        upserts = [(id, c.get("$metadata") or {}) for id, c in changes.items() if c["$operation"] != "D" and c.get("vector") is not None]
+        with self._lock:
+            kept = ~np.isin(self._ids, changed_ids)
+            ids = self._ids[kept]
+            values = {name: self._values[name][kept] for name in self._columns}
+            if (len(upserts) > 0):
+                ids = np.concatenate([ids, np.asarray([u[0] for u in upserts], dtype=np.int64)])
+                for name in self._columns:
+                    values[name] = np.concatenate([values[name], self.__encode(name, [u[1].get(name) for u in upserts])])
+            self.__set(ids, values)
+
+    def evaluate(self, predicates:list[tuple]) -> np.ndarray:
+        with self._lock:
+            mask = np.ones(len(self._ids), dtype=bool)
+            for column, op, value in predicates:
+                mask &= self.__evaluate(column, op, value)
+            return self._ids[mask]
+
+    def get_status(self):
+        return {
+            "rows": len(self._ids),
+            "columns": self._columns,
+            "memory_usage": self._ids.nbytes + sum([v.nbytes for v in self._values.values()])
+        }
+
+    def __set(self, ids:np.ndarray, values:dict[str, np.ndarray]):
+        # rows are kept sorted by id, last one wins when an id is there more than once
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        last = np.append(ids[1:] != ids[:-1], True) if len(ids) > 0 else np.empty((0), dtype=bool)
+        self._ids = ids[last]
+        self._values = {name: values[name][order][last] for name in self._columns}
+
+    def __evaluate(self, column:str, op:str, value) -> np.ndarray:
+        if (column not in self._columns):
+            raise ValueError(f"Unknown metadata column: {column}")
+
+        if (op in ("in", "not_in") and not isinstance(value, list)):
+            raise ValueError(f"Operator {op} needs a list of values.")
+        if (op == "prefix" and not isinstance(value, str)):
+            raise ValueError(f"Operator {op} needs a string value.")
+
+        values = self._values[column]
+        if (self._columns[column] == "STRING"):
+            dictionary = self._dictionaries[column]
+            match op:
+                case "eq":
+                    return values == dictionary.get(value, -2)
+                case "ne":
+                    return values != dictionary.get(value, -2)
+                case "in":
+                    return np.isin(values, [dictionary.get(v, -2) for v in value])
+                case "not_in":
+                    return ~np.isin(values, [dictionary.get(v, -2) for v in value])
+                case "prefix":
+                    return np.isin(values, [c for v, c in dictionary.items() if v.startswith(value)])
+                case _:
+                    raise ValueError(f"Operator {op} is not supported for string column {column}.")
+
+        match op:
+            case "eq":
+                return values == self.__encode_value(column, value)
+            case "ne":
+                return values != self.__encode_value(column, value)
+            case "lt":
+                return values < self.__encode_value(column, value)
+            case "le":
+                return values <= self.__encode_value(column, value)
+            case "gt":
+                return values > self.__encode_value(column, value)
+            case "ge":
+                return values >= self.__encode_value(column, value)
+            case "in":
+                return np.isin(values, self.__encode(column, value))
+            case "not_in":
+                return ~np.isin(values, self.__encode(column, value))
+            case _:
+                raise ValueError(f"Operator {op} is not supported for column {column}.")
+
+    def __encode_value(self, column:str, value):
+        try:
+            return self.__encode(column, [value])[0]
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid value for column {column}: {value}") from e
+
+    def __encode(self, column:str, values:list) -> np.ndarray:
+        match self._columns[column]:
+            case "NUMBER":
+                return np.asarray([np.nan if v is None else v for v in values], dtype=np.float64)
+            case "DATE":
+                return np.asarray([np.datetime64("NaT") if v is None else np.datetime64(v, "s") for v in values], dtype="datetime64[s]")
+            case "STRING":
+                dictionary = self._dictionaries[column]
+                return np.asarray([-1 if v is None else dictionary.setdefault(v, len(dictionary)) for v in values], dtype=np.int32)
+
+    def __empty(self, column:str) -> np.ndarray:
+        match self._columns[column]:
+            case "NUMBER":
+                return np.empty((0), dtype=np.float64)
+            case "DATE":
+                return np.empty((0), dtype="datetime64[s]")
+            case "STRING":
+                return np.empty((0), dtype=np.int32)
@@ -0,0 +1,77 @@
+import struct
+import numpy as np
+import faiss
+
+# faiss.write_index doesn't support IndexShards, sharded indexes are saved as this header followed by each shard
+SHARDS_FOURCC = b"IxSh"
+
+def new_index_shards(shards:list[faiss.Index]) -> faiss.IndexShards:
+    # shards are searched in parallel threads and their results merged, they all keep their own ids
+    index = faiss.IndexShards(shards[0].d, True, False)
+    for shard in shards:
+        index.add_shard(shard)
+    # IndexShards doesn't own its shards, the python objects must live as long as it does
+    index.referenced_objects = shards
+    return index
+
+def is_sharded(index:faiss.Index) -> bool:
+    return isinstance(faiss.downcast_index(index), faiss.IndexShards)
+
+def get_shards(index:faiss.Index) -> list[faiss.Index]:
+    index = faiss.downcast_index(index)
+    if (not isinstance(index, faiss.IndexShards)):
+        return [index]
+    return [faiss.downcast_index(index.at(i)) for i in range(index.count())]
+
+# multiplicative (Fibonacci) hashing constant, 2^64 / golden ratio
+SHARD_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+def get_shard_numbers(ids:np.ndarray, shards:int) -> np.ndarray:
+    # an id always belongs to the same shard, so that a change only touches the shard that owns it. Ids are hashed
+    # first, keeping the high bits of the product, so that strided ids (eg: all even) still spread over all shards
+    hashed = (np.asarray(ids, dtype=np.int64).view(np.uint64) * SHARD_HASH) >> np.uint64(32)
+    return (hashed % np.uint64(shards)).astype(np.int64)
+
+def split_by_shard(ids:np.ndarray, shards:int):
+    numbers = get_shard_numbers(ids, shards)
+    for n in range(shards):
+        yield n, np.flatnonzero(numbers == n)
+
+def clone_index_shards(index:faiss.Index) -> faiss.Index:
+    if (not is_sharded(index)):
+        return faiss.clone_index(index)
+    return new_index_shards([faiss.clone_index(s) for s in get_shards(index)])
+
+def copy_index_shards(index:faiss.Index) -> faiss.Index:
+    # clone_index keeps viewing memory mapped codes, a copy read back from the serialized index owns them
+    if (not is_sharded(index)):
+        return faiss.deserialize_index(faiss.serialize_index(index))
+    return new_index_shards([faiss.deserialize_index(faiss.serialize_index(s)) for s in get_shards(index)])
+
+def write_index_shards(index:faiss.Index, write, block_size:int):
+    writer = faiss.PyCallbackIOWriter(write, block_size)
+    if (not is_sharded(index)):
+        faiss.write_index(index, writer)
+        return
+    shards = get_shards(index)
+    write(SHARDS_FOURCC + struct.pack("<i", len(shards)))
+    for shard in shards:
+        faiss.write_index(shard, writer)
+
+def read_index_shards(read, block_size:int) -> faiss.Index:
+    head = read(4)
+    if (head != SHARDS_FOURCC):
+        # a single index, its first bytes are handed back to faiss.read_index
+        pending = head
+        def read_single(size:int) -> bytes:
+            nonlocal pending
+            result = pending[:size]
+            pending = pending[size:]
+            if (len(result) < size):
+                result += read(size - len(result))
+            return result
+        return faiss.read_index(faiss.PyCallbackIOReader(read_single, block_size))
+
+    count = struct.unpack("<i", read(4))[0]
+    reader = faiss.PyCallbackIOReader(read, block_size)
+    return new_index_shards([faiss.read_index(reader) for _ in range(count)])
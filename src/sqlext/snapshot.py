@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+import faiss
+from .shards import new_index_shards, is_sharded, get_shards
+
+_logger = logging.getLogger("uvicorn")
+
+class SnapshotCache:
+    def __init__(self, path:str, index_num:int) -> None:
+        self._path = path
+        self._index_num = index_num
+        self._index_file = os.path.join(path, f"index-{index_num}.faiss")
+        self._metadata_file = os.path.join(path, f"index-{index_num}.json")
+        os.makedirs(path, exist_ok=True)
+
+    def get_version(self) -> int:
+        metadata = self.__read_metadata()
+        if (metadata is None):
+            return None
+        return metadata["data_version"]
+
+    def read(self, mmap:bool) -> faiss.Index:
+        metadata = self.__read_metadata()
+        # only the codes are mapped (they're most of the index), they can't be changed in place
+        flags = faiss.IO_FLAG_MMAP_IFC if mmap else 0
+        _logger.info(f"Reading index snapshot from {self._index_file} (mmap: {flags != 0})...")
+        shards = metadata.get("shards", 0)
+        if (shards > 0):
+            return new_index_shards([faiss.read_index(self.__get_shard_file(i), flags) for i in range(shards)])
+        return faiss.read_index(self._index_file, flags)
+
+    def write(self, index:faiss.Index, data_version:int):
+        _logger.info(f"Writing index snapshot to {self._index_file}...")
+        # files are replaced, not overwritten, so that a memory mapped snapshot stays valid
+        shards = get_shards(index) if is_sharded(index) else []
+        for i, shard in enumerate(shards):
+            self.__write_index(shard, self.__get_shard_file(i))
+        if (len(shards) == 0):
+            self.__write_index(index, self._index_file)
+        metadata = {
+            "data_version": data_version,
+            "shards": len(shards)
+        }
+        with open(self._metadata_file + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(self._metadata_file + ".tmp", self._metadata_file)
+
+    def __write_index(self, index:faiss.Index, file:str):
+        faiss.write_index(index, file + ".tmp")
+        os.replace(file + ".tmp", file)
+
+    def __get_shard_file(self, shard:int) -> str:
+        return os.path.join(self._path, f"index-{self._index_num}-shard-{shard}.faiss")
+
+    def __read_metadata(self):
+        if (not os.path.exists(self._metadata_file)):
+            return None
+        with open(self._metadata_file) as f:
+            metadata = json.load(f)
+        shards = metadata.get("shards", 0)
+        files = [self.__get_shard_file(i) for i in range(shards)] if shards > 0 else [self._index_file]
+        if (not all([os.path.exists(f) for f in files])):
+            return None
+        return metadata
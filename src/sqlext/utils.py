@@ -1,6 +1,11 @@
 import json
+import time
+import hashlib
+import threading
 import numpy as np
 from enum import StrEnum, Enum
+from contextlib import contextmanager
+from collections import OrderedDict
 
 class IndexStatus(StrEnum):
     INITIALIZING = 'initializing'
@@ -11,19 +16,179 @@ class IndexStatus(StrEnum):
     CREATING = 'creating'
     TRAINING = 'training'    
     NOINDEX = 'noindex'
+    UNLOADED = 'unloaded'
 
 class IndexSubStatus(StrEnum):
     NONE = 'none'
     READY = 'ready'
     SAVING = 'saving'
+    BUILDING = 'building'
+    LOADING = 'loading'
 
 class UpdateResult(Enum):
     DONE = 0
     NO_CHANGES = 1
     INDEX_NOT_READY = 2
     INDEX_IS_STALE = 3
+    INDEX_BUSY = 4
+    PARTIAL = 5
     UNKNOWN = -1
 
+class ReadWriteLock:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._condition:
+            # waiting writers go first, so that a steady flow of readers doesn't starve them
+            while (self._writer or self._waiting_writers > 0):
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if (self._readers == 0):
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._condition:
+            self._waiting_writers += 1
+            while (self._writer or self._readers > 0):
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+class SearchOptions:
+    def __init__(self, nprobe:int = None, ef_search:int = None, threshold:float = None, 
+                 ids:list[int] = None, exclude_ids:list[int] = None, id_ranges:list[tuple[int, int]] = None,
+                 predicates:list[tuple] = None):
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.threshold = threshold
+        self.ids = ids
+        self.exclude_ids = exclude_ids
+        self.id_ranges = id_ranges
+        # (column, operator, value) conditions on metadata columns, all of them must match
+        self.predicates = predicates
+        self._key = None
+
+    def has_filter(self) -> bool:
+        return self.ids is not None or bool(self.exclude_ids) or bool(self.id_ranges) or bool(self.predicates)
+
+    def get_key(self):
+        if (self._key is None):
+            # id lists can be long, so they're part of the key as a hash
+            filter_key = None
+            if (self.has_filter()):
+                filter_key = hashlib.blake2b(repr((self.ids, self.exclude_ids, self.id_ranges, self.predicates)).encode(), digest_size=16).digest()
+            self._key = (self.nprobe, self.ef_search, self.threshold, filter_key)
+        return self._key
+
+class ResultCache:
+    def __init__(self, size:int, ttl_seconds:int = None):
+        self._size = size or 0
+        self._ttl = ttl_seconds
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._size > 0
+
+    def get_key(self, vector:np.ndarray, limit:int, data_version:int, options:SearchOptions):
+        return (hashlib.blake2b(vector.tobytes(), digest_size=16).digest(), limit, data_version, options.get_key())
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if (item is not None and self._ttl and time.monotonic() - item[0] > self._ttl):
+                del self._items[key]
+                item = None
+            if (item is None):
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic(), value)
+            self._items.move_to_end(key)
+            while (len(self._items) > self._size):
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_status(self):
+        return {
+            "size": len(self._items),
+            "max_size": self._size,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+class BuildProgress:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reason:str = None
+        self.phase:str = None
+        self.rows = 0
+        self.total_rows:int = None
+        self.error:str = None
+        self._started = None
+        self._finished = None
+
+    def start(self, reason:str):
+        with self._lock:
+            self.reason = reason
+            self.phase = "loading"
+            self.rows = 0
+            self.total_rows = None
+            self.error = None
+            self._started = time.monotonic()
+            self._finished = None
+
+    def add_rows(self, count:int):
+        # partitions are loaded in parallel
+        with self._lock:
+            self.rows += count
+
+    def finish(self, error:Exception = None):
+        self.phase = "failed" if error else "done"
+        self.error = str(error) if error else None
+        self._finished = time.monotonic()
+
+    def get_status(self):
+        if (self._started is None):
+            return None
+        return {
+            "reason": self.reason,
+            "phase": self.phase,
+            "rows": self.rows,
+            "total_rows": self.total_rows,
+            "progress": round(min(self.rows / self.total_rows, 1) * 100, 1) if self.total_rows else None,
+            "elapsed_seconds": round((self._finished or time.monotonic()) - self._started, 1),
+            "error": self.error
+        }
+
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.int32):
@@ -40,6 +205,36 @@ class NpEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
+class VectorFormat(StrEnum):
+    JSON = 'JSON'
+    BINARY = 'BINARY'
+
+class IndexFormat(StrEnum):
+    PICKLE = 'PICKLE'
+    FAISS = 'FAISS'
+
+# SQL native vector binary format: 2 bytes header (169, 1), item count as int32, 2 filler bytes, float32 items
+VECTOR_HEADER = (169, 1)
+VECTOR_HEADER_SIZE = 8
+
+def vectors_from_json(values:list[str]) -> np.ndarray:
+    # parse the whole batch in a single call instead of one json.loads per row
+    return np.asarray(json.loads("[" + ",".join(values) + "]"), dtype=np.float32)
+
+def vectors_from_binary(values:list[bytes], dimensions:int) -> np.ndarray:
+    row_size = VECTOR_HEADER_SIZE + dimensions * 4
+    raw = np.frombuffer(b"".join(values), dtype=np.uint8)
+    if (raw.size != len(values) * row_size):
+        raise Exception(f"Binary vectors must have {dimensions} dimensions.")
+
+    raw = raw.reshape(len(values), row_size)
+    if not (np.all(raw[:, 0] == VECTOR_HEADER[0]) and np.all(raw[:, 1] == VECTOR_HEADER[1])):
+        raise Exception("Invalid binary vector header.")
+    if not np.all(raw[:, 2:6].view("<i4") == dimensions):
+        raise Exception(f"Binary vectors must have {dimensions} dimensions.")
+
+    return raw[:, VECTOR_HEADER_SIZE:].view("<f4")
+
 class Buffer:
     def __init__(self):
         self.ids = []
@@ -54,14 +249,44 @@ class Buffer:
         self.vectors.clear()
 
 class VectorSet:
-    def __init__(self, vector_dimensions:int):
-        self.ids = np.empty((0), dtype=np.int32)
-        self.vectors = np.empty((0, vector_dimensions), dtype=np.float32)      
-             
-    def add(self, buffer:Buffer):
-        self.ids = np.append(self.ids, np.asarray(buffer.ids), 0)
-        self.vectors = np.append(self.vectors, np.asarray(buffer.vectors, dtype=np.float32), 0)          
+    def __init__(self, vector_dimensions:int, capacity:int = 0):
+        self._count = 0
+        self._ids = np.empty((capacity), dtype=np.int64)
+        self._vectors = np.empty((capacity, vector_dimensions), dtype=np.float32)
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self._count]
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[:self._count]
+
+    def __len__(self):
+        return self._count
+
+    def add(self, ids, vectors):
+        n = len(ids)
+        self._reserve(self._count + n)
+        self._ids[self._count:self._count + n] = ids
+        self._vectors[self._count:self._count + n] = vectors
+        self._count += n
+
+    def clear(self):
+        self._count = 0
+
+    def _reserve(self, capacity:int):
+        if (capacity <= len(self._ids)):
+            return
+
+        # grow geometrically so that an underestimated capacity doesn't turn into a copy per batch
+        capacity = max(capacity, int(len(self._ids) * 1.5))
+        ids = np.empty((capacity), dtype=np.int64)
+        vectors = np.empty((capacity, self._vectors.shape[1]), dtype=np.float32)
+        ids[:self._count] = self.ids
+        vectors[:self._count] = self.vectors
+        self._ids = ids
+        self._vectors = vectors
 
     def get_memory_usage(self):
-        return self.ids.nbytes + self.vectors.nbytes
-    
+        return self._ids.nbytes + self._vectors.nbytes